@@ -0,0 +1,95 @@
+""" collision.py
+
+run it with `python3 -m benchmarks.collision` from the repository root.
+
+measures the cost of a single Player.update movement step on growing maps.
+with the spatial index the cost per move should stay flat, while a scan
+over every wall and item grows with the map.
+
+Usage:
+    collision.py [--moves=<n>] [--bombs=<n>]
+
+Options:
+    --moves=<n>     movement steps per map size [default: 20000]
+    --bombs=<n>     bombs scattered over each map [default: 48]
+"""
+import random
+import time
+from itertools import chain
+
+from docopt import docopt
+
+from bomber.callback import Signal
+from bomber.geometry import Rect
+from bomber.engine import Map, COLLIDING_OBJECTS, TILE_WIDTH, TILE_HEIGHT
+from bomber.maps import generate_layout
+
+SIZES = (25, 49, 99, 199, 399)
+PLAYERS = 8
+
+
+class NullClient:
+
+    def __init__(self):
+        self.on_message = Signal()
+
+    def inform(self, msg_type, args):
+        pass
+
+
+def scan(player, walls, frame):
+    """ the full scan over every wall and item Player.update used to do """
+    return [w for w in chain(walls, (i.frame for i in player.map.items if isinstance(i, COLLIDING_OBJECTS)))
+        if frame.colliderect(w) and not player.frame.colliderect(w)]
+
+
+def run(size, moves, bombs):
+    random.seed(size)
+    level = Map(layout=generate_layout(size, size), seed=size)
+
+    players = []
+    for i in range(PLAYERS):
+        level.player_register(NullClient(), username="bench{}".format(i))
+    players = list(level.players)
+
+    for _ in range(bombs):
+        player = random.choice(players)
+        x, y = random.randrange(size), random.randrange(size)
+        player.frame.left, player.frame.top = x * TILE_WIDTH, y * TILE_HEIGHT
+        player.update_position()
+        level.plant_bomb(player, fuse_time=1e9)
+    for player in players:
+        player.resurrect()
+
+    dt = 1 / 30
+    start = time.perf_counter()
+    for i in range(moves):
+        player = players[i % PLAYERS]
+        if not player.moving:
+            player.do_move(random.choice("wasd"), 1)
+        player.update(dt)
+    per_move = (time.perf_counter() - start) / moves
+
+    walls = [Rect(x * TILE_WIDTH, y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
+        for x, y, _ in level.wall_tiles()]
+    frame = players[0].frame
+    start = time.perf_counter()
+    for _ in range(moves // 10):
+        scan(players[0], walls, frame)
+    per_scan = (time.perf_counter() - start) / (moves // 10)
+
+    return len(walls) + len(level.items), per_move, per_scan
+
+
+def main(arguments):
+    moves = int(arguments["--moves"])
+    bombs = int(arguments["--bombs"])
+    print("{:>6} {:>8} {:>14} {:>14}".format("size", "objects", "move (us)", "full scan (us)"))
+    for size in SIZES:
+        objects, per_move, per_scan = run(size, moves, bombs)
+        print("{:>6} {:>8} {:>14.2f} {:>14.2f}".format(
+            "{0}x{0}".format(size), objects, per_move * 1e6, per_scan * 1e6))
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -0,0 +1,223 @@
+""" loadtest.py
+
+run it with `python3 -m benchmarks.loadtest` from the repository root.
+
+starts the server in-process and drives synthetic msgpack clients against
+it over TCP. every client connects, moves, plants bombs and polls
+what_bombs, what_foes and the map at the given rates, with --batch the moves, bombs
+and polls go out together as one batch message. a match holds at
+most eight players, so the clients are spread over as many matches as
+needed, all of them simulated by the same tick scheduler.
+
+Usage:
+    loadtest.py [--clients=<n>] [--duration=<s>] [--move-rate=<hz>] [--bomb-rate=<hz>]
+                [--poll-rate=<hz>] [--map-rate=<hz>] [--tick-rate=<n>] [--port=<port>] [--seed=<n>]
+                [--batch]
+
+Options:
+    --clients=<n>       number of synthetic clients [default: 8]
+    --duration=<s>      seconds to run the load [default: 10]
+    --move-rate=<hz>    move commands per client and second [default: 10]
+    --bomb-rate=<hz>    bomb commands per client and second [default: 0.5]
+    --poll-rate=<hz>    what_bombs and what_foes requests per client and second [default: 10]
+    --map-rate=<hz>     map requests per client and second [default: 1]
+    --tick-rate=<n>     simulation ticks per second [default: 30]
+    --port=<port>       first port, every match gets its own [default: 8101]
+    --seed=<n>          seed for the maps and the clients [default: 0]
+    --batch             send move, bomb, what_bombs and what_foes in one batch at the poll rate
+"""
+import asyncio
+import random
+import time
+from collections import defaultdict, deque
+
+import msgpack
+from docopt import docopt
+
+from bomber.clock import TickScheduler
+from bomber.engine import Map
+from bomber.network import Server
+
+PLAYERS_PER_MATCH = 8
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Stats:
+
+    def __init__(self):
+        self.tick_times = []
+        self.latencies = defaultdict(list)
+        self.sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.errors = 0
+
+
+class SyntheticClient:
+
+    """ a bot that speaks the real protocol and measures the round trips """
+
+    def __init__(self, name, port, stats, rates, rng, batch=False):
+        self.name = name
+        self.batch = batch
+        self.port = port
+        self.stats = stats
+        self.rates = rates
+        self.rng = rng
+        # replies come in the order of the requests
+        self.pending = deque()
+        self.writer = None
+
+    def send(self, msg_type, **kwargs):
+        kwargs["type"] = msg_type
+        self.pending.append((msg_type, time.perf_counter()))
+        self.writer.write(msgpack.packb(kwargs))
+        self.stats.sent += 1
+
+    def send_batch(self):
+        """ what the separate actions would send in the same time, as one message """
+        poll = self.rates["poll"]
+        commands = []
+        if self.rng.random() < self.rates["move"] / poll:
+            commands.append({"type": "move", "direction": self.rng.choice("wasd"), "distance": 1})
+        if self.rng.random() < self.rates["bomb"] / poll:
+            commands.append({"type": "bomb"})
+        commands += [{"type": "what_bombs"}, {"type": "what_foes"}]
+        self.send("batch", commands=commands)
+
+    async def receive(self, reader):
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        while not reader.at_eof():
+            data = await reader.read(65536)
+            if not data:
+                break
+            self.stats.bytes_received += len(data)
+            unpacker.feed(data)
+            now = time.perf_counter()
+            for reply in unpacker:
+                self.stats.received += 1
+                if not self.pending:
+                    continue
+                msg_type, sent = self.pending.popleft()
+                self.stats.latencies[msg_type].append(now - sent)
+                if isinstance(reply, (list, tuple)) and reply and reply[0] == "ERR":
+                    self.stats.errors += 1
+
+    async def periodic(self, rate, action):
+        if rate <= 0:
+            return
+        # spread the clients over the interval
+        await asyncio.sleep(self.rng.random() / rate)
+        while True:
+            action()
+            await asyncio.sleep(1 / rate)
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.send("connect", username=self.name)
+        receiver = asyncio.ensure_future(self.receive(reader))
+        actions = [
+            (self.rates["move"], lambda: self.send(
+                "move", direction=self.rng.choice("wasd"), distance=1)),
+            (self.rates["bomb"], lambda: self.send("bomb")),
+            (self.rates["poll"], lambda: self.send("what_bombs")),
+            (self.rates["poll"], lambda: self.send("what_foes")),
+            (self.rates["map"], lambda: self.send("map")),
+        ]
+        if self.batch:
+            actions = [(self.rates["poll"], self.send_batch), (self.rates["map"], lambda: self.send("map"))]
+        tasks = [asyncio.ensure_future(self.periodic(rate, action)) for rate, action in actions]
+        try:
+            await receiver
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run(arguments, stats):
+    loop = asyncio.get_event_loop()
+    clients = int(arguments["--clients"])
+    port = int(arguments["--port"])
+    seed = int(arguments["--seed"])
+    rng = random.Random(seed)
+
+    servers = []
+    for i in range((clients + PLAYERS_PER_MATCH - 1) // PLAYERS_PER_MATCH):
+        server = Server(host="127.0.0.1", port=port + i, level=Map(seed=seed + i))
+        await server.run_server()
+        servers.append(server)
+
+    def tick(dt):
+        start = time.perf_counter()
+        for server in servers:
+            server.level.update(dt)
+            server.flush()
+        stats.tick_times.append(time.perf_counter() - start)
+
+    scheduler = TickScheduler(rate=int(arguments["--tick-rate"]), loop=loop)
+    scheduler.on_tick.connect(tick)
+    ticker = asyncio.ensure_future(scheduler.run())
+
+    rates = {
+        "move": float(arguments["--move-rate"]),
+        "bomb": float(arguments["--bomb-rate"]),
+        "poll": float(arguments["--poll-rate"]),
+        "map": float(arguments["--map-rate"]),
+    }
+    synthetic = [
+        SyntheticClient("load{}".format(i), port + i // PLAYERS_PER_MATCH, stats, rates,
+                        random.Random(rng.random()), batch=arguments["--batch"])
+        for i in range(clients)
+    ]
+    tasks = [asyncio.ensure_future(client.run()) for client in synthetic]
+
+    await asyncio.sleep(float(arguments["--duration"]))
+
+    for client in synthetic:
+        client.close()
+    for task in tasks:
+        task.cancel()
+    scheduler.stop()
+    await asyncio.wait(tasks + [ticker])
+    for server in servers:
+        server.server.close()
+    return scheduler
+
+
+def report(stats, duration, scheduler):
+    ms = lambda seconds: seconds * 1000
+    print("ticks: {} (dropped {})".format(len(stats.tick_times), scheduler.dropped_ticks))
+    print("tick time ms   p50 {:8.3f}   p90 {:8.3f}   p99 {:8.3f}   max {:8.3f}".format(
+        ms(percentile(stats.tick_times, 0.5)), ms(percentile(stats.tick_times, 0.9)),
+        ms(percentile(stats.tick_times, 0.99)), ms(max(stats.tick_times or [float("nan")]))))
+    print()
+    print("{:<12} {:>8} {:>10} {:>10} {:>10}".format("request", "count", "p50 ms", "p90 ms", "p99 ms"))
+    for msg_type, latencies in sorted(stats.latencies.items()):
+        print("{:<12} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            msg_type, len(latencies), ms(percentile(latencies, 0.5)),
+            ms(percentile(latencies, 0.9)), ms(percentile(latencies, 0.99))))
+    print()
+    print("sent {:.0f} msg/s, received {:.0f} msg/s, {:.1f} KiB/s, {} errors".format(
+        stats.sent / duration, stats.received / duration,
+        stats.bytes_received / duration / 1024, stats.errors))
+
+
+def main(arguments):
+    loop = asyncio.get_event_loop()
+    stats = Stats()
+    scheduler = loop.run_until_complete(run(arguments, stats))
+    report(stats, float(arguments["--duration"]), scheduler)
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
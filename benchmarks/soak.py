@@ -0,0 +1,86 @@
+""" soak.py
+
+run it with `python3 -m benchmarks.soak` from the repository root.
+
+fills a match with in-process bots and simulates it as fast as the CPU
+allows, without sockets, msgpack or rendering, so the numbers are the cost
+of the engine itself. the bot policies can be decided in a thread or a
+process pool.
+
+with --check-danger the incrementally updated danger map is compared with
+a full recomputation after every tick, the run fails at the first tick
+where they differ.
+
+Usage:
+    soak.py [--bots=<n>] [--ticks=<n>] [--tick-rate=<n>] [--seed=<n>] [--pool=<kind>] [--workers=<n>]
+            [--profile] [--check-danger]
+
+Options:
+    --bots=<n>          number of bots, a match holds at most eight [default: 8]
+    --ticks=<n>         ticks to simulate [default: 9000]
+    --tick-rate=<n>     simulated ticks per second, sets dt [default: 30]
+    --seed=<n>          seed for the map and the bots [default: 0]
+    --pool=<kind>       decide the policies in a "thread" or "process" pool
+    --workers=<n>       size of the pool [default: 4]
+    --profile           run under cProfile and print the hottest functions
+    --check-danger      check the danger map against a full recomputation every tick
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from docopt import docopt
+
+from bomber.bots import Bots
+from bomber.engine import Map
+
+
+def main(arguments):
+    seed = int(arguments["--seed"])
+    ticks = int(arguments["--ticks"])
+    dt = 1 / int(arguments["--tick-rate"])
+
+    executor = None
+    if arguments["--pool"] == "thread":
+        executor = ThreadPoolExecutor(int(arguments["--workers"]))
+    elif arguments["--pool"] == "process":
+        executor = ProcessPoolExecutor(int(arguments["--workers"]))
+
+    level = Map(seed=seed)
+    bots = Bots(level, executor=executor, seed=seed)
+    for i in range(int(arguments["--bots"])):
+        bots.add("bot{}".format(i))
+
+    profile = None
+    if arguments["--profile"]:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    check_danger = arguments["--check-danger"]
+    start = time.perf_counter()
+    for _ in range(ticks):
+        level.update(dt)
+        if check_danger and level.danger.update() != level.danger.recompute():
+            raise SystemExit("the danger map differs from a full recomputation in tick {}".format(
+                level.tick))
+    duration = time.perf_counter() - start
+
+    if profile is not None:
+        import pstats
+        profile.disable()
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+    if executor is not None:
+        executor.shutdown()
+
+    print("{} bots, {} ticks in {:.2f}s: {:.0f} ticks/s, {:.1f}x realtime".format(
+        len(bots), ticks, duration, ticks / duration, ticks * dt / duration))
+    print("{} bomb commands, {} move commands".format(
+        level.metrics.histogram("handler.bomb").count, level.metrics.histogram("handler.move").count))
+    for name, histogram in level.metrics.snapshot()["histograms"].items():
+        if name.startswith("tick"):
+            print("{:<20} p50 {p50_ms:8.3f} ms   p99 {p99_ms:8.3f} ms   max {max_ms:8.3f} ms".format(
+                name, **histogram))
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
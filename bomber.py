@@ -3,53 +3,164 @@
 a bomberman clone server.
 
 Usage:
+    bomber.py [--headless] [--map=<file>] [--seed=<n>] [--tick-rate=<n>] [--max-catchup=<n>] [--stats-port=<port>]
+              [--record=<file>] [--bots=<n>] [--max-clients=<n>] [--idle-timeout=<s>] [--slow-clients=<policy>]
+    bomber.py --lobby [--workers=<n>] [--players=<n>] [--map=<file>] [--tick-rate=<n>] [--max-catchup=<n>]
 
-    bomber.py
+Options:
+    --headless          run the simulation without pygame/SDL and without a window
+    --lobby             accept clients for many headless matches run by worker processes
+    --workers=<n>       number of worker processes, defaults to the number of cores
+    --players=<n>       players per match in lobby mode [default: 8]
+    --map=<file>        the map file [default: simple.map]
+    --seed=<n>          seed for the random walls, a random one if not given
+    --stats-port=<port> serve the tick profile and metrics as json on this local port
+    --record=<file>     log the match for python3 -m bomber.replay
+    --bots=<n>          fill the match with in-process bot players
+    --max-clients=<n>   connections the server accepts [default: 64]
+    --idle-timeout=<s>  drop players that sent nothing for this many seconds [default: 60]
+    --slow-clients=<policy>  "drop" the updates a slow client did not ask for and only
+                        disconnect it when it falls far behind, or "disconnect" it
+                        right away [default: drop]
+    --tick-rate=<n>     simulation ticks per second [default: 30]
+    --max-catchup=<n>   missed ticks that are simulated in one batch, the rest follow in the
+                        next batches [default: 5]
 """
 import asyncio
 import time
-import pygameui as ui
 from docopt import docopt
-from bomber.scenes import LoadingScene, MapScene
+from bomber.clock import TickScheduler
+from bomber.metrics import StatsServer
 from bomber.network import Server
 from bomber.engine import Map
 
+# the window draws at most this often
+FRAME_TIME = 1 / 30
 
-@asyncio.coroutine
-def main_loop(loop):
-    now = last = time.time()
-    time_per_frame = 1 / 30
 
+def run_window(path, commands):
+    """
+    the window process, it draws the snapshots the simulation publishes to
+    the ring at path and sends the keys back through the commands queue
+    """
+    import pygameui as ui
+    from bomber.scenes import LoadingScene, MapScene
+    from bomber.snapshot import SnapshotMap, SnapshotRing
+
+    level = SnapshotMap(SnapshotRing.open(path), commands)
+    ui.init("bomber", (900, 700))
+
+    # show loading scene
+    ui.scene.push(LoadingScene())
+    map_scene = MapScene(level)
+    ui.scene.insert(0, map_scene)
+
+    # show game ui
+    ui.scene.pop()
+    last = time.perf_counter()
     while True:
-        # 30 frames per second, considering computation/drawing time
-        yield from asyncio.sleep(last + time_per_frame - now)
-        last, now = now, time.time()
-        dt = now - last
-        if ui.single_loop_run(dt*1000):
+        level.refresh()
+        now = time.perf_counter()
+        if ui.single_loop_run((now - last) * 1000):
             return
+        last = now
+        time.sleep(max(FRAME_TIME - (time.perf_counter() - now), 0))
+
+
+def main_lobby(arguments):
+    from bomber.lobby import Lobby
+
+    loop = asyncio.get_event_loop()
+    lobby = Lobby(
+        workers=int(arguments["--workers"]) if arguments["--workers"] else None,
+        players_per_match=int(arguments["--players"]),
+        tick_rate=int(arguments["--tick-rate"]),
+        max_catchup=int(arguments["--max-catchup"]),
+        mapfile=arguments["--map"],
+    )
+    loop.run_until_complete(lobby.run_server())
+    try:
+        loop.run_forever()
+    finally:
+        lobby.stop_workers()
+        loop.close()
 
 
 def main(arguments):
-    # init async and pygame
+    if arguments["--lobby"]:
+        return main_lobby(arguments)
+
+    # init async and the simulation
     loop = asyncio.get_event_loop()
-    ui.init("bomber", (900, 700))
+    level = Map(
+        mapfile=arguments["--map"],
+        seed=int(arguments["--seed"]) if arguments["--seed"] else None,
+    )
 
-    # show loading scene
-    ui.scene.push(LoadingScene())
-    map_scene = MapScene(Map(ui.Rect(10, 10, 490, 490)))
-    ui.scene.insert(0, map_scene)
+    recorder = None
+    if arguments["--record"]:
+        from bomber.replay import Recorder
+        recorder = Recorder(arguments["--record"], level, int(arguments["--tick-rate"]))
 
-    gameserver = Server(level=map_scene.map)
-    asyncio.async(gameserver.run_server())
+    gameserver = Server(
+        level=level,
+        recorder=recorder,
+        max_clients=int(arguments["--max-clients"]),
+        idle_timeout=float(arguments["--idle-timeout"]),
+        slow_clients=arguments["--slow-clients"],
+    )
+    asyncio.ensure_future(gameserver.run_server())
+    if arguments["--bots"]:
+        from bomber.bots import Bots
+        bots = Bots(level, server=gameserver)
+        for i in range(int(arguments["--bots"])):
+            bots.add("bot{}".format(i))
 
     # from bomber.network import ClientStub
-    # loop.call_soon(map_scene.map.player_register, ClientStub(None, None, map_scene.map))
+    # loop.call_soon(level.player_register, ClientStub(None, None, level))
+
+    scheduler = TickScheduler(
+        rate=int(arguments["--tick-rate"]),
+        max_catchup=int(arguments["--max-catchup"]),
+        loop=loop,
+    )
+    scheduler.on_tick.connect(level.update)
+    level.metrics.gauge("dropped_ticks", lambda: scheduler.dropped_ticks)
+    if arguments["--stats-port"]:
+        stats = StatsServer(level.metrics, port=int(arguments["--stats-port"]))
+        asyncio.ensure_future(stats.run_server())
+    # replies are queued during the tick and written once at its end
+    scheduler.on_tick.connect(lambda dt: gameserver.flush())
+
+    ring = None
+    if not arguments["--headless"]:
+        # the window runs in its own process, a slow frame does not delay the ticks
+        import multiprocessing
+        from bomber.bots import LoopbackClient
+        from bomber.snapshot import SnapshotRing, receive_commands
+
+        ring = SnapshotRing.create(level._map.shape)
+        commands = multiprocessing.Queue()
+        window = multiprocessing.Process(target=run_window, args=(ring.path, commands), daemon=True)
+        window.start()
+        # the keys of the window steer a player of its own, its commands are
+        # queued, ordered and recorded like those of every other client
+        window_client = gameserver.add_client(("window", 0), LoopbackClient(level))
+        scheduler.on_tick.connect(lambda dt: receive_commands(window_client, commands))
+        scheduler.on_tick.connect(lambda dt: ring.publish(level))
+
+        def window_closed(dt):
+            if not window.is_alive():
+                scheduler.stop()
+        scheduler.on_frame.connect(window_closed)
 
-    # show game ui
-    ui.scene.pop()
     try:
-        loop.run_until_complete(main_loop(loop))
+        loop.run_until_complete(scheduler.run())
     finally:
+        if recorder is not None:
+            recorder.close()
+        if ring is not None:
+            ring.close(unlink=True)
         loop.close()
 
 
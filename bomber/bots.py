@@ -0,0 +1,130 @@
+import random
+from collections import deque, namedtuple
+
+from bomber.danger import NEIGHBOURS
+from bomber.engine import PackedReply, TILE_WIDTH
+from bomber.network import ClientStub
+
+# what a policy gets to see of the match, plain data so it can be sent to a process pool
+Observation = namedtuple("Observation", [
+    "tick", "name", "position", "alive", "moving", "free", "threatened", "escape", "seed",
+])
+
+
+def wander(observation):
+    """ walk around at random, drop a bomb now and then and run from fire """
+    if not observation.alive or observation.moving:
+        return []
+    if observation.threatened:
+        if observation.escape is None:
+            return []
+        return [{"type": "move", "direction": observation.escape, "distance": 1}]
+    rng = random.Random(observation.seed)
+    commands = []
+    if rng.random() < 0.05:
+        commands.append({"type": "bomb", "fuse_time": 2})
+    if observation.free:
+        commands.append({"type": "move", "direction": rng.choice(observation.free), "distance": 1})
+    return commands
+
+
+class LoopbackClient(ClientStub):
+
+    """ a ClientStub for a bot in the same process, nothing is packed or written """
+
+    def __init__(self, level):
+        super().__init__(None, None, level)
+        # the latest replies, for policies that care
+        self.replies = deque(maxlen=64)
+
+    def inform(self, msg_type, args):
+        if self.state != "closed":
+            self.replies.append((msg_type, args, self.level.tick))
+
+    def send_packed(self, data):
+        # shared replies of the what_* queries keep what was packed, other frames are dropped
+        if isinstance(data, PackedReply) and self.state != "closed":
+            self.replies.append(data.reply + (self.level.tick,))
+
+    def flush(self):
+        pass
+
+
+class Bots:
+
+    """
+    in-process bot players for a Map
+
+    every tick each bot gets an Observation of the map and its policy
+    returns the commands it sends. the commands are queued like the ones
+    from the network and applied in the next tick. with a Server the bots
+    are added as its clients, so their commands are ordered and recorded
+    like everybody else's.
+
+    policies are plain functions of the observation. with an executor
+    (a concurrent.futures thread or process pool) they are decided while
+    the simulation goes on and their commands are sent one tick later.
+    """
+
+    def __init__(self, level, server=None, executor=None, seed=0):
+        self.level = level
+        self.server = server
+        self.executor = executor
+        self.seed = seed
+        # (client, name, policy)
+        self.bots = []
+        self.pending = []
+        level.on_tick.connect(self.tick)
+
+    def __len__(self):
+        return len(self.bots)
+
+    def add(self, name, policy=wander):
+        client = LoopbackClient(self.level)
+        if self.server is not None:
+            self.server.add_client(("bot", name), client)
+        else:
+            client.number = len(self.bots)
+        client.receive({"type": "connect", "username": name})
+        self.bots.append((client, name, policy))
+        return client
+
+    def observe(self, player, name, number):
+        level = self.level
+        x, y = position = player.position_int
+        danger = level.danger
+        threatened = position in danger.update()
+        escape = None
+        if threatened:
+            escape = danger.escape(position, TILE_WIDTH / player.speed)
+        free = "".join(direction for direction, (dx, dy) in NEIGHBOURS
+            if not level.blocked((x + dx, y + dy)))
+        return Observation(
+            level.tick, name, position, player.alive, player.moving > 0,
+            free, threatened, escape, hash((self.seed, number, level.tick)),
+        )
+
+    def tick(self, tick):
+        if self.server is None:
+            # nobody else applies the queued commands
+            for client, _, _ in self.bots:
+                for entry in client.take():
+                    client.apply(entry)
+
+        # decided by the executor during the last tick
+        for client, future in self.pending:
+            for msg in future.result():
+                client.receive(msg)
+        self.pending = []
+
+        players = {player.client: player for player in self.level.players}
+        for client, name, policy in self.bots:
+            player = players.get(client)
+            if player is None or client.state == "closed":
+                continue
+            observation = self.observe(player, name, client.number)
+            if self.executor is not None:
+                self.pending.append((client, self.executor.submit(policy, observation)))
+            else:
+                for msg in policy(observation):
+                    client.receive(msg)
@@ -0,0 +1,20 @@
+class Signal:
+
+    """
+    minimal replacement for pygameui.callback.Signal, so the simulation
+    and the network code run without pygameui
+    """
+
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        if slot in self.slots:
+            self.slots.remove(slot)
+
+    def __call__(self, *args, **kwargs):
+        for slot in self.slots:
+            slot(*args, **kwargs)
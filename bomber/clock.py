@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+from itertools import count
+
+from bomber.callback import Signal
+
+
+class Timer:
+
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class GameClock:
+
+    """
+    timers in game time
+
+    the clock only moves when the simulation advances it, so timers fire
+    after the same number of ticks no matter how busy the host is.
+    """
+
+    def __init__(self):
+        self.time = 0.
+        self._timers = []
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.time + delay, callback, args)
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+        return timer
+
+    def advance(self, dt):
+        target = self.time + dt
+        timers = self._timers
+        while timers and timers[0][0] <= target:
+            when, _, timer = heapq.heappop(timers)
+            if timer.cancelled:
+                continue
+            self.time = when
+            timer.callback(*timer.args)
+        self.time = target
+
+
+class TickScheduler:
+
+    """
+    runs the simulation at a fixed rate
+
+    every tick gets the same dt. ticks are scheduled on absolute times, so
+    sleeping too long does not accumulate drift. missed ticks are caught up
+    in batches of at most max_catchup, the rest is carried over to the next
+    batches, so the event loop gets to run in between. only ticks that are
+    more than max_lag seconds behind are dropped instead of spiraling.
+    """
+
+    def __init__(self, rate=30, max_catchup=5, max_lag=1., loop=None):
+        self.rate = rate
+        self.tick_time = 1 / rate
+        self.max_catchup = max_catchup
+        self.max_lag = max_lag
+        self.loop = loop or asyncio.get_event_loop()
+        self.tick = 0
+        self.dropped_ticks = 0
+        self.running = False
+        # called with the fixed dt for every simulated tick
+        self.on_tick = Signal()
+        # called once per batch of ticks with the wall clock time since the last batch
+        self.on_frame = Signal()
+
+    def stop(self):
+        self.running = False
+
+    async def run(self):
+        self.running = True
+        next_tick = last_frame = self.loop.time()
+
+        while self.running:
+            await asyncio.sleep(max(0, next_tick - self.loop.time()))
+            now = self.loop.time()
+
+            due = int((now - next_tick) / self.tick_time) + 1
+            limit = max(int(self.max_lag * self.rate), self.max_catchup)
+            if due > limit:
+                # too far behind, forget about the ticks older than max_lag
+                self.dropped_ticks += due - limit
+                next_tick += (due - limit) * self.tick_time
+                due = limit
+
+            # the ticks that are still due after this batch follow right away
+            ticks = min(due, self.max_catchup)
+            for _ in range(ticks):
+                self.tick += 1
+                self.on_tick(self.tick_time)
+            next_tick += ticks * self.tick_time
+
+            self.on_frame(now - last_frame)
+            last_frame = now
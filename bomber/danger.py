@@ -0,0 +1,207 @@
+import heapq
+from collections import deque
+from itertools import count
+
+# direction: (x, y) offset, in the order tiles are explored
+NEIGHBOURS = (("a", (-1, 0)), ("d", (1, 0)), ("w", (0, -1)), ("s", (0, 1)))
+
+
+class DangerMap:
+
+    """
+    when the tiles of a Map will be on fire
+
+    for every tile that is burning or will burn it keeps the game time the
+    fire starts and when it is out again. ticking bombs go off at the end
+    of their fuse or earlier if another bomb's blast reaches them first,
+    chain reactions are resolved like the ExplosionEngine does.
+
+    times are absolute game times, so the map only changes when a bomb is
+    planted, goes off or burns out or a wall is destroyed. then only the
+    fire of these bombs is recomputed, together with the ticking bombs
+    their old or new blast reaches, the rest of the grid stays as it is.
+    """
+
+    def __init__(self, map, follow=True):
+        self.map = map
+        # (x, y) -> (start, end)
+        self.fire = {}
+        # bomb -> (cells, start, end) of its fire
+        self.bombs = {}
+        # (x, y) -> bombs whose fire reaches the tile
+        self.sources = {}
+        # bombs that changed since the last update
+        self.changed = {}
+        # map version the predicted blasts were cast at
+        self._version = None
+        if follow:
+            map.explosions.on_change.connect(self.bomb_changed)
+
+    def bomb_changed(self, bomb):
+        self.changed[bomb] = None
+
+    def update(self):
+        map = self.map
+        changed, self.changed = self.changed, {}
+        if self._version != map.version:
+            tiles = map.tile_changes(self._version)
+            self._version = map.version
+            if tiles is None:
+                # more wall changes than the log holds, start over
+                self.fire, self.bombs, self.sources = {}, {}, {}
+                changed = dict.fromkeys(item for item in map.items if hasattr(item, "state"))
+            else:
+                # the predicted rays of ticking bombs stopped at these walls
+                for x, y, _ in tiles:
+                    for bomb in self.sources.get((x, y), ()):
+                        if bomb.state == "ticking":
+                            changed[bomb] = None
+        if changed:
+            self.refresh(changed)
+        return self.fire
+
+    def recompute(self):
+        """ the fire computed from scratch, update() has to give the same """
+        fresh = DangerMap(self.map, follow=False)
+        fresh.refresh([item for item in self.map.items if hasattr(item, "state")])
+        return fresh.fire
+
+    def ticking_at(self, cell):
+        return [obj for obj in self.map.index.at(cell) if getattr(obj, "state", None) == "ticking"]
+
+    def refresh(self, bombs):
+        """ recompute the fire of the given bombs and of the ticking bombs they may set off """
+        explosions = self.map.explosions
+
+        # bomb -> the cells it will burn, None for bombs that are gone
+        affected = {}
+        pending = list(bombs)
+        while pending:
+            bomb = pending.pop()
+            if bomb in affected:
+                continue
+            state = bomb.state
+            if state == "ticking":
+                # the blast as it would be with the walls standing now
+                cells = explosions.cast(bomb.position_int, bomb.explosion_radius).cells
+            elif state in ("exploding", "burning"):
+                cells = explosions.blast(bomb).cells
+            else:
+                cells = None
+            affected[bomb] = cells
+            # the bombs this one did or will set off may go off at another time now
+            old = self.bombs.get(bomb)
+            for reached in (old[0] if old else (), cells if state == "ticking" else ()):
+                for cell in reached:
+                    pending.extend(self.ticking_at(cell))
+
+        touched = set()
+        for bomb in affected:
+            old = self.bombs.pop(bomb, None)
+            if old is None:
+                continue
+            for cell in old[0]:
+                sources = self.sources[cell]
+                del sources[bomb]
+                if not sources:
+                    del self.sources[cell]
+                touched.add(cell)
+
+        def burn(bomb, cells, start, end):
+            self.bombs[bomb] = (cells, start, end)
+            for cell in cells:
+                self.sources.setdefault(cell, {})[bomb] = None
+            touched.update(cells)
+
+        # earliest detonation of every affected ticking bomb, chain reactions included
+        sequence = count()
+        queue = []
+        for bomb, cells in affected.items():
+            state = bomb.state
+            if state in ("exploding", "burning"):
+                start = bomb.detonated
+                burn(bomb, cells, start, start + bomb.exploding_time + bomb.burn_time)
+            elif state == "ticking":
+                goes_off = bomb.deadline
+                fuse = explosions.fuses.get(bomb)
+                if fuse is not None:
+                    goes_off = min(goes_off, fuse.when)
+                # set off by a ticking bomb that did not change
+                for other in self.sources.get(bomb.position_int, ()):
+                    if other.state == "ticking":
+                        goes_off = min(goes_off, self.bombs[other][1] + other.ignite_time)
+                heapq.heappush(queue, (goes_off, next(sequence), bomb))
+
+        done = set()
+        while queue:
+            goes_off, _, bomb = heapq.heappop(queue)
+            if bomb in done:
+                continue
+            done.add(bomb)
+            cells = affected[bomb]
+            burn(bomb, cells, goes_off, goes_off + bomb.exploding_time + bomb.burn_time)
+            for cell in cells:
+                for other in self.ticking_at(cell):
+                    if other in affected and other not in done:
+                        heapq.heappush(queue, (goes_off + bomb.ignite_time, next(sequence), other))
+
+        fire = self.fire
+        for cell in touched:
+            sources = self.sources.get(cell)
+            if not sources:
+                fire.pop(cell, None)
+                continue
+            times = [self.bombs[bomb] for bomb in sources]
+            fire[cell] = (min(start for _, start, _ in times), max(end for _, _, end in times))
+
+    def cells(self):
+        """ [x, y, seconds until the tile burns, seconds until it is out] """
+        now = self.map.clock.time
+        return [
+            [x, y, max(start - now, 0.), end - now]
+            for (x, y), (start, end) in sorted(self.update().items())
+        ]
+
+    def walk(self, start, step_time, max_steps=None):
+        """
+        breadth first walk over the tiles reachable from start without
+        walking through fire, yields (tile, steps, first step, never burns)
+
+        step_time is the time needed to walk from one tile to the next, the
+        first step is the direction to leave start in, None for start.
+        """
+        fire = self.update()
+        now = self.map.clock.time
+        seen = {start}
+        queue = deque([(start, 0, None)])
+        while queue:
+            (x, y), steps, first = queue.popleft()
+            yield (x, y), steps, first, (x, y) not in fire
+            if max_steps is not None and steps >= max_steps:
+                continue
+            arrival = steps * step_time
+            for direction, (dx, dy) in NEIGHBOURS:
+                cell = (x + dx, y + dy)
+                if cell in seen or self.map.blocked(cell):
+                    continue
+                seen.add(cell)
+                if cell in fire:
+                    start_time, end_time = fire[cell]
+                    # on the tile from arrival until the next step is done
+                    if start_time - now <= arrival + 2 * step_time and end_time - now >= arrival:
+                        continue
+                queue.append((cell, steps + 1, first or direction))
+
+    def reachable(self, start, step_time, max_steps=None):
+        """ tiles that never burn and can be reached from start, as [x, y, seconds to get there] """
+        return [
+            [x, y, steps * step_time]
+            for (x, y), steps, _, safe in self.walk(start, step_time, max_steps) if safe
+        ]
+
+    def escape(self, start, step_time, max_steps=None):
+        """ direction of the first step towards the closest tile that never burns, None if there is none """
+        for _, _, first, safe in self.walk(start, step_time, max_steps):
+            if safe:
+                return first
+        return None
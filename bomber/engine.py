@@ -1,8 +1,21 @@
-import re
+import inspect
+import math
 import random
-import pygameui as ui
-from itertools import chain
-import asyncio
+from collections import OrderedDict, deque
+from itertools import islice
+import msgpack
+import numpy as np
+from bomber.callback import Signal
+from bomber.clock import GameClock
+from bomber.danger import DangerMap
+from bomber.entities import EntityStore
+from bomber.explosion import ExplosionEngine
+from bomber.geometry import Rect
+from bomber.metrics import Metrics
+from bomber.maps import (
+    DESTRUCTABLE_WALL, INDESTRUCTABLE_WALL, DESTROYED_WALL, TILE_CHARS, IS_WALL, load_layout
+)
+from bomber.spatial import SpatialIndex
 
 TILE_WIDTH = 10
 TILE_HEIGHT = 10
@@ -15,50 +28,61 @@ directions = {
     "d": (1, 0),
 }
 
-
-def feedblock(line):
-    while line:
-        attr, block, line = line[0], line[1], line[2:]
-        yield attr, block
+# number of tile changes a client can fall behind before it gets a full snapshot
+MAP_CHANGE_LOG = 1024
+# players that left whose points are kept for a reconnect, the oldest are forgotten
+MAX_DEPARTED = 1024
+# commands in a single batch message
+MAX_BATCH = 16
+AREA_ERROR = "radius is a number of tiles >= 0, view is [left, top, width, height] in tiles"
+
+TILE_COLORS = {
+    DESTRUCTABLE_WALL: (200, 100, 100),
+    INDESTRUCTABLE_WALL: (100, 100, 100),
+}
 
 
-def first(iterator):
-    for elem in iterator:
-        return elem
+def tile_position(frame):
+    return (round(frame.left / TILE_WIDTH), round(frame.top / TILE_HEIGHT))
 
 
 class MapObject:
 
-    char = "Q"
-    hidden = False
-    color = (100, 100, 100)
+    __slots__ = ("frame", "char", "hidden", "color", "index", "store", "eid", "position_int")
 
     def __init__(self, frame):
         self.frame = frame
-
-    @property
-    def position_int(self):
-        return (round(self.frame.left / TILE_WIDTH), round(self.frame.top / TILE_HEIGHT))
+        self.char = "Q"
+        self.hidden = False
+        self.color = (100, 100, 100)
+        self.index = None
+        self.store = None
+        self.eid = None
+        # map objects never move, so the tile is computed once
+        self.position_int = tile_position(frame)
 
     @property
     def position_float(self):
         return (round(self.frame.left / TILE_WIDTH, 1), round(self.frame.top / TILE_HEIGHT, 1))
 
-    def update(self, dt):
-        pass
-
     def hide(self):
         self.hidden = True
         self.char = self.char.lower()
+        if self.index is not None:
+            self.index.remove(self)
+        if self.store is not None:
+            self.store.remove(self)
 
 
 class FireTrail(MapObject):
 
+    __slots__ = ("bomb",)
+
     def __init__(self, bomb, start, end):
         x, y = start
         _x, _y = end
 
-        frame = ui.Rect(
+        frame = Rect(
             min(x, _x) * TILE_WIDTH,
             min(y, _y) * TILE_HEIGHT,
             (abs(x - _x) + 1) * TILE_WIDTH,
@@ -71,10 +95,16 @@ class FireTrail(MapObject):
 
 class Bomb(MapObject):
 
+    __slots__ = (
+        "player", "fuse_time", "burn_time", "exploding_time", "ignite_time", "deadline", "timer",
+        "_state", "explosion_radius", "destroyed_walls", "fire_trails", "ignited", "blast",
+        "detonated",
+    )
+
     def __init__(self, player, fuse_time, position):
 
         x, y = position
-        frame = ui.Rect(
+        frame = Rect(
             x * TILE_WIDTH,
             y * TILE_HEIGHT,
             TILE_WIDTH,
@@ -86,13 +116,39 @@ class Bomb(MapObject):
         self.burn_time = 1.5
         self.exploding_time = 0.2
         self.ignite_time = 0.1
-        self.update_timer = fuse_time
         self._state = "ticking"
         self.color = (10, 10, 10)
         self.explosion_radius = player.explosion_radius
         self.hidden = False
         self.destroyed_walls = []
         self.fire_trails = []
+        # set by the ExplosionEngine, detonated is the game time the bomb went off
+        self.ignited = False
+        self.blast = None
+        self.detonated = None
+        # the bomb is only woken up by the map's clock when its state is due to change
+        self.timer = None
+        self.schedule(fuse_time)
+
+    @property
+    def update_timer(self):
+        """ seconds until the next state """
+        return max(self.deadline - self.player.map.clock.time, 0.)
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.player.map.clock.call_later(delay, self.expire)
+        self.deadline = self.timer.when
+
+    def expire(self):
+        self.timer = None
+        if self.state == "ticking":
+            self.state = "exploding"
+        elif self.state == "exploding":
+            self.state = "burning"
+        elif self.state == "burning":
+            self.state = "hiding"
 
     @property
     def state(self):
@@ -110,108 +166,83 @@ class Bomb(MapObject):
         assert value in state_transitions[self._state]
 
         if self._state != value:
+            if self._state == "ticking":
+                self.player.live_bombs -= 1
             self._state = value
             self.on_new_state(value)
 
     def on_new_state(self, state):
         if state == "exploding":
             self.color = (255, 255, 230)
-            self.update_timer = self.exploding_time
+            self.schedule(self.exploding_time)
+            self.player.map.explosions.detonate(self)
             self.deploy_fire_trails()
         elif state == "burning":
             self.color = (255, 55, 10)
-            self.update_timer = self.burn_time
+            self.schedule(self.burn_time)
         elif state == "hiding":
             self.hide()
             for fire_trail in self.fire_trails:
                 fire_trail.hide()
-            self.player.points += len([w for w in self.destroyed_walls if not w.hidden])
-            for wall in self.destroyed_walls:
-                wall.hide()
+            self.player.map.explosions.extinguish(self)
+            self.player.points += self.player.map.destroy_walls(self.destroyed_walls)
 
     def deploy_fire_trails(self):
-        for direction in "wasd":
-            left, top = directions[direction]
-            x, y = self.position_int
-            for i in range(self.explosion_radius + 1):
-                _x = x + i * left
-                _y = y + i * top
-                if _x < 0 or _y < 0:
-                    break
-                try:
-                    tile = self.player.map._map[_y][_x]
-                    if isinstance(tile, Wall) and not tile.hidden:
-                        if tile.destructable:
-                            self.destroyed_walls.append(tile)
-                        break
-                except IndexError:
-                    pass
-            fire_trail = FireTrail(self, (x, y), (_x, _y))
-            self.player.map.items.append(fire_trail)
+        x, y = self.position_int
+        for end, destroys_wall in self.player.map.explosions.blast(self).rays:
+            if destroys_wall:
+                self.destroyed_walls.append(end)
+            fire_trail = FireTrail(self, (x, y), end)
+            self.player.map.items.add(fire_trail)
+            self.player.map.index.insert(fire_trail)
             self.fire_trails.append(fire_trail)
 
     def ignite(self):
         if self.state == "ticking":
             self.state = "exploding"
 
-    def update(self, dt):
-        loop = asyncio.get_event_loop()
-
-        if self.state in ("exploding", "burning"):
-            for fire_trail in self.fire_trails:
-                for player in self.player.map.players:
-                    if not player.alive:
-                        continue
-                    if fire_trail.frame.colliderect(player.frame):
-                        player.die()
-                for bomb in self.player.map.items:
-                    if not isinstance(bomb, Bomb) or bomb.state != "ticking":
-                        continue
-                    if fire_trail.frame.colliderect(bomb.frame):
-                        loop.call_later(self.ignite_time, lambda x: x.ignite(), bomb)
-
-        time_to_tick = min(dt, self.update_timer)
-        dt -= time_to_tick
-        self.update_timer -= time_to_tick
-        if self.update_timer <= 0:
-            if self.state == "ticking":
-                self.state = "exploding"
-            elif self.state == "exploding":
-                self.state = "burning"
-            elif self.state == "burning":
-                self.state = "hiding"
-
-
-class GroundBlock(MapObject):
 
-    char = "g"
-    color = (0, 200, 0)
 
+COLLIDING_OBJECTS = (Bomb,)
 
-class Wall(MapObject):
-    pass
 
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
 
-class DestructableWall(Wall):
 
-    char = "W"
-    color = (200, 100, 100)
-    destructable = True
+def arguments(**checks):
+    """
+    value checks for the arguments of a do_* handler as name=(check,
+    description), handler_table keeps them. dispatch answers an argument
+    that fails its check with ERR instead of running the handler.
+    """
+    def decorate(handler):
+        handler.checks = checks
+        return handler
+    return decorate
 
 
-class IndestructableWall(Wall):
+DIRECTION = (lambda value: isinstance(value, str) and value in directions, "one of w, a, s, d")
+NOT_NEGATIVE = (lambda value: is_number(value) and value >= 0, "a number >= 0")
+STEPS = (lambda value: value is None or isinstance(value, int) and value >= 0, "a number of steps >= 0")
 
-    char = "M"
-    color = (100, 100, 100)
-    destructable = False
 
+class PackedReply(bytes):
 
-COLLIDING_OBJECTS = (IndestructableWall, DestructableWall, Bomb)
+    """ a reply packed once for many clients, reply keeps (msg_type, args) for batches """
 
 
 class Player:
 
+    __slots__ = (
+        "__x", "__y", "frame", "_top", "_left", "_position", "name", "client", "color",
+        "password", "speed", "bombamount", "explosion_radius", "moving", "direction", "id",
+        "map", "points", "alive", "hidden", "live_bombs", "index", "aoi", "aoi_sent",
+    )
+
     def __init__(self, position, client, name="Hans", color=None, password="", id=None, map=None):
+        # the map's SpatialIndex once registered
+        self.index = None
         x, y = position
         self.__x = x
         self.__y = y
@@ -241,13 +272,25 @@ class Player:
         self.points = 0
         self.alive = True
         self.hidden = False
+        # ticking bombs of this player
+        self.live_bombs = 0
+        # area of interest subscription, [left, top, width, height] in tiles
+        # around the player, and the last update sent for it
+        self.aoi = None
+        self.aoi_sent = None
         client.on_message.connect(self.handle_msg)
 
         self.client.inform("OK", self.whoami_data)
 
     @property
     def position_int(self):
-        return (round(self.frame.left / TILE_WIDTH), round(self.frame.top / TILE_HEIGHT))
+        return self._position
+
+    def update_position(self):
+        """ call this after the frame changed, it caches the tile position """
+        self._position = tile_position(self.frame)
+        if self.index is not None:
+            self.index.move(self)
 
     @property
     def next_position_int(self):
@@ -285,64 +328,163 @@ class Player:
 
     def die(self, hard=False):
         print("die {}, tonight you dine in hell".format(self.name))
-        loop = asyncio.get_event_loop()
 
         self.alive = False
         self.hidden = True
         if not hard:
-            loop.call_later(5, self.resurrect)
+            self.map.clock.call_later(5, self.resurrect)
         self.points -= 10
 
     def resurrect(self):
         self.alive = True
         self.hidden = False
-        self.frame = ui.Rect(self.__x * TILE_WIDTH, self.__y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
+        self.frame = Rect(self.__x * TILE_WIDTH, self.__y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
         self._top = float(self.frame.top)
         self._left = float(self.frame.left)
+        self.update_position()
 
     def handle_msg(self, msg):
         if not self.alive:
             self.client.inform("ERR", "you are dead")
             return
-        msg_type = msg.pop("type")
-        try:
-            handler = getattr(self, "do_{}".format(msg_type))
-            ret = handler(**msg)
-            if ret:
-                if isinstance(ret, tuple) and len(ret) == 2:
-                    self.client.inform(* ret)
+        reply = self.dispatch(msg)
+        if isinstance(reply, bytes):
+            # already packed, shared with other clients
+            self.client.send_packed(reply)
+        elif reply is not None:
+            self.client.inform(*reply)
+
+    def dispatch(self, msg):
+        """ run the handler of a command, returns the reply, packed or (msg_type, args) """
+        msg_type = msg.pop("type", None) if isinstance(msg, dict) else None
+        entry = HANDLERS.get(msg_type) if isinstance(msg_type, str) else None
+        if entry is None:
+            return ("ERR", "The function ({}) you are calling is not available".format(msg_type))
+        handler, required, checks, metric = entry
+        for name in required:
+            if name not in msg:
+                return ("ERR", "{} needs the argument {}".format(msg_type, name))
+        for name, (check, description) in checks.items():
+            if name in msg and not check(msg[name]):
+                return ("ERR", "{} needs {} to be {}".format(msg_type, name, description))
+        with self.map.metrics.time(metric):
+            ret = handler(self, **msg)
+        if isinstance(ret, bytes):
+            return ret
+        if ret:
+            if isinstance(ret, tuple) and len(ret) == 2:
+                return ret
+            return None
+        return ("ACK", ret)
+
+    def do_batch(self, commands, **kwargs):
+        """ run up to MAX_BATCH commands, their replies come back as one BATCH reply """
+        if not isinstance(commands, list) or len(commands) > MAX_BATCH:
+            return ("ERR", "a batch is a list of at most {} commands".format(MAX_BATCH))
+        replies = []
+        for msg in commands:
+            if isinstance(msg, dict) and msg.get("type") != "batch":
+                # the handlers consume the message, the caller may still need it
+                reply = self.dispatch(dict(msg))
             else:
-                self.client.inform("ACK", ret)
-        except AttributeError:
-            self.client.inform("ERR",
-                "The function ({}) you are calling is not available".format(msg_type))
+                reply = ("ERR", "a batch holds commands, not {!r}".format(msg))
+            if isinstance(reply, bytes):
+                reply = reply.reply
+            replies.append(reply)
+        return ("BATCH", replies)
+
+    def do_stats(self, **kwargs):
+        return ("STATS", self.map.metrics.snapshot())
 
     def do_whoami(self, **kwargs):
         return ("WHOAMI", self.whoami_data)
 
     def do_map(self, **kwargs):
-        return("MAP", "\n".join(
-            "".join(e.char for e in line) for line in self.map._map),)
+        return ("MAP", self.map.serialize())
 
-    def do_move(self, direction, distance=1., **kwargs):
-        assert direction in "wasd"
-        assert isinstance(distance, (int, float))
+    def do_map_delta(self, version=None, **kwargs):
+        return ("MAP_DELTA", self.map.delta(version))
 
+    @arguments(direction=DIRECTION, distance=NOT_NEGATIVE)
+    def do_move(self, direction, distance=1., **kwargs):
         self.direction = direction
         self.moving = distance * 10  # TODO, don't use constant
-
-    def do_bomb(self, **kwargs):
-        self.map.plant_bomb(self, fuse_time=kwargs.get("fuse_time", 5))
-
-    def do_what_bombs(self, **kwargs):
-        return ("WHAT_BOMBS", [
-            (b.position_int, b.update_timer, b.state,) for b in self.map.items if isinstance(b, Bomb)
-        ])
-
-    def do_what_foes(self, **kwargs):
-        return ("WHAT_FOES", [
-            (p.position_int, p.direction, p.id, p.name) for p in self.map.players
-        ])
+        # only the direction in the foes changed, positions change during the tick
+        self.map.invalidate_queries("WHAT_FOES")
+
+    @arguments(fuse_time=NOT_NEGATIVE)
+    def do_bomb(self, fuse_time=5, **kwargs):
+        self.map.plant_bomb(self, fuse_time=fuse_time)
+
+    def do_what_bombs(self, radius=None, view=None, **kwargs):
+        if radius is not None or view is not None:
+            frame = self.area(radius, view)
+            if frame is None:
+                return ("ERR", AREA_ERROR)
+            return ("WHAT_BOMBS", self.map.bomb_states(frame))
+        return self.map.packed_query("WHAT_BOMBS", self.map.bomb_states)
+
+    def do_what_foes(self, radius=None, view=None, **kwargs):
+        if radius is not None or view is not None:
+            frame = self.area(radius, view)
+            if frame is None:
+                return ("ERR", AREA_ERROR)
+            return ("WHAT_FOES", self.map.foe_states(frame))
+        return self.map.packed_query("WHAT_FOES", self.map.foe_states)
+
+    def do_subscribe(self, radius=None, view=None, **kwargs):
+        """ get an AOI update with the foes and bombs in the area whenever they change """
+        if self.area(radius, view) is None:
+            return ("ERR", AREA_ERROR)
+        self.aoi = (radius, view)
+        self.aoi_sent = None
+
+    def do_unsubscribe(self, **kwargs):
+        self.aoi = self.aoi_sent = None
+
+    def area(self, radius=None, view=None):
+        """
+        the frame of an area of interest: radius tiles around the player
+        or a view [left, top, width, height] in tiles. it is clipped to the
+        map, None if the arguments do not describe an area
+        """
+        if view is not None:
+            if not (isinstance(view, (list, tuple)) and len(view) == 4 and all(isinstance(v, int) for v in view)):
+                return None
+            left, top, width, height = view
+            if width <= 0 or height <= 0:
+                return None
+        else:
+            if not isinstance(radius, int) or radius < 0:
+                return None
+            x, y = self.position_int
+            left, top = x - radius, y - radius
+            width = height = 2 * radius + 1
+        frame = Rect(left * TILE_WIDTH, top * TILE_HEIGHT, width * TILE_WIDTH, height * TILE_HEIGHT)
+        return frame.clip(self.map.frame)
+
+    def send_aoi(self):
+        frame = self.area(*self.aoi)
+        state = [self.map.foe_states(frame), self.map.bomb_states(frame)]
+        if state != self.aoi_sent and self.client.push("AOI", state):
+            self.aoi_sent = state
+
+    @arguments(max_steps=STEPS)
+    def do_danger(self, safe=False, max_steps=None, **kwargs):
+        """
+        the tiles that burn or will burn, with safe=True also the tiles
+        this player can flee to
+        """
+        if not safe:
+            return self.map.packed_query("DANGER", lambda: [self.map.danger.cells(), None])
+        return ("DANGER", [self.map.danger.cells(), self.safe_cells(max_steps)])
+
+    @arguments(max_steps=STEPS)
+    def do_safe_cells(self, max_steps=None, **kwargs):
+        return ("SAFE_CELLS", self.safe_cells(max_steps))
+
+    def safe_cells(self, max_steps=None):
+        return self.map.danger.reachable(self.position_int, TILE_WIDTH / self.speed, max_steps)
 
     def update(self, dt):
         if not self.moving > 0 or not self.alive:
@@ -371,29 +513,26 @@ class Player:
             self.moving = 0
 
         # collision detection with walls
-        frame = ui.Rect(_left, _top, TILE_WIDTH, TILE_HEIGHT)   # possible new position
-        collision_frame = ui.Rect(
+        frame = Rect(_left, _top, TILE_WIDTH, TILE_HEIGHT)   # possible new position
+        collision_frame = Rect(
             min(self.frame.left, frame.left),
             min(self.frame.top, frame.top),
             abs(self.frame.left - frame.left) + TILE_WIDTH,
             abs(self.frame.top - frame.top) + TILE_HEIGHT,
         )
 
-        # TODO it is the jurisdiction of Map to tell the Player about colliding walls
-        # Now it is even more complicated to move this to the Map object
-        # because it cannot inlcude objects that are placed on
-
-        collisions = [wall for wall in chain(self.map.walls, self.map.items)
-            if isinstance(wall, COLLIDING_OBJECTS) and collision_frame.colliderect(wall.frame)
-                and not self.frame.colliderect(wall.frame)]
+        # only the tiles covered by collision_frame are looked at,
+        # objects we are already standing on (e.g. our own bomb) are ignored
+        collisions = [wall for wall in self.map.colliders(collision_frame)
+            if not self.frame.colliderect(wall)]
         if collisions:
             collision = True
             if self.direction == "w":
                 # get the lowest box
-                collisions = sorted(collisions, key=lambda x: x.frame.top, reverse=True)
-                collider = [c for c in collisions if c.position_int == self.next_position_int]
+                collisions = sorted(collisions, key=lambda x: x.top, reverse=True)
+                collider = [c for c in collisions if tile_position(c) == self.next_position_int]
                 if collider:
-                    frame.top = collisions[0].frame.bottom
+                    frame.top = collisions[0].bottom
                     _top = frame.top
                 else:
                     # no valid collision
@@ -401,10 +540,10 @@ class Player:
 
             elif self.direction == "a":
                 # get the box farest right
-                collisions = sorted(collisions, key=lambda x: x.frame.left, reverse=True)
-                collider = [c for c in collisions if c.position_int == self.next_position_int]
+                collisions = sorted(collisions, key=lambda x: x.left, reverse=True)
+                collider = [c for c in collisions if tile_position(c) == self.next_position_int]
                 if collider:
-                    frame.left = collisions[0].frame.right
+                    frame.left = collisions[0].right
                     _left = frame.left
                 else:
                     # no valid collision
@@ -412,10 +551,10 @@ class Player:
 
             elif self.direction == "s":
                 # get the highest box
-                collisions = sorted(collisions, key=lambda x: x.frame.top)
-                collider = [c for c in collisions if c.position_int == self.next_position_int]
+                collisions = sorted(collisions, key=lambda x: x.top)
+                collider = [c for c in collisions if tile_position(c) == self.next_position_int]
                 if collider:
-                    frame.bottom = collisions[0].frame.top
+                    frame.bottom = collisions[0].top
                     _top = frame.top
                 else:
                     # no valid collision
@@ -423,10 +562,10 @@ class Player:
 
             elif self.direction == "d":
                 # get the box farest left
-                collisions = sorted(collisions, key=lambda x: x.frame.left)
-                collider = [c for c in collisions if c.position_int == self.next_position_int]
+                collisions = sorted(collisions, key=lambda x: x.left)
+                collider = [c for c in collisions if tile_position(c) == self.next_position_int]
                 if collider:
-                    frame.right = collisions[0].frame.left
+                    frame.right = collisions[0].left
                     _left = frame.left
                 else:
                     # no valid collision
@@ -449,82 +588,246 @@ class Player:
 
         self.frame.top = self._top = _top
         self.frame.left = self._left = _left
+        self.update_position()
+
+
+def handler_table(cls):
+    """
+    message type -> (handler, required arguments, argument checks, histogram
+    name) for the do_* methods of cls, built once instead of looking them up
+    per message
+    """
+    table = {}
+    for name in dir(cls):
+        if not name.startswith("do_"):
+            continue
+        handler = getattr(cls, name)
+        parameters = list(inspect.signature(handler).parameters.values())[1:]
+        required = tuple(
+            p.name for p in parameters
+            if p.default is p.empty and p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)
+        )
+        checks = getattr(handler, "checks", {})
+        table[name[3:]] = (handler, required, checks, "handler.{}".format(name[3:]))
+    return table
 
 
-class Map(ui.View):
-
-    def __init__(self, frame):
-        super().__init__(frame)
+HANDLERS = handler_table(Player)
 
-        with open("simple.map") as fh:
-            mapdata = fh.read()
 
-        def rand_wall(match):
-            if random.random() < 0.6:
-                return " W"
-            return " g"
+class Map:
 
-        mapdata = re.sub(r" ( )", rand_wall, mapdata)
-        lines = mapdata.splitlines()
+    """
+    the pure python simulation of a match, it does not know anything about
+    pygame. the window draws it from snapshots, see bomber.snapshot.
+    """
 
-        spawnpoints = []
-        freespawnpoints = []
+    def __init__(self, mapfile="simple.map", seed=None, layout=None):
+        if layout is None:
+            layout = load_layout(mapfile)
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        # the layout and the seed place the random walls, keep them to reproduce the map
+        self.layout = layout
+        self.seed = seed
+        self._map = layout.instantiate(seed)
+        self._attr = layout.attrs
 
-        self.walls = []
-        self.items = []
+        self.items = EntityStore()
         self.players = []
-        self.spawnpoints = {}
+        # username -> spawn point of the players in the match
         self.users = {}
-
-        self._map = []
-        for y, mapline in enumerate(lines):
-            line = []
-            for x, (attr, block) in enumerate(feedblock(mapline)):
-                frame = ui.Rect(x * TILE_WIDTH, y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
-                item = GroundBlock(frame)
-                if block == "W":
-                    item = DestructableWall(frame)
-                    self.walls.append(item)
-                elif block == "M":
-                    item = IndestructableWall(frame)
-                    self.walls.append(item)
-                elif block == "S":
-                    # this is a spawn point
-                    # attr is the start position
-                    self.spawnpoints[attr] = (x, y)
-                    freespawnpoints.append(attr)
-                line.append(item)
-            self._map.append(line)
-
-        self.freespawnpoints = sorted(freespawnpoints, reverse=True)
-
-        self.on_player_join = ui.callback.Signal()
-        self.on_player_leave = ui.callback.Signal()
-        self.on_update_player = ui.callback.Signal()
-
-        # self.on_keydown.register(self.keydown)
-
-    def key_down(self, key, code):
-        if not self.players:
-            return
-
-        key_code = code.lower()
-        if key_code in ["w", "a", "s", "d"]:
-            self.players[0].do_move(key_code, 2.5)
-        elif code.lower() == "b":
-            self.players[0].do_bomb()
-
-    def player_register(self, client, username, password="", **kw):
-        try:
-            if username in self.users:
-                position = self.users[username]
-            else:
-                position = self.freespawnpoints.pop()
-                self.users[username] = position
-        except StopIteration as e:
+        # username -> (password, points) of players that left, a reconnect
+        # with the password keeps the points
+        self.departed = OrderedDict()
+        self.clock = GameClock()
+        self.index = SpatialIndex(TILE_WIDTH, TILE_HEIGHT)
+        self.explosions = ExplosionEngine(self)
+        self.danger = DangerMap(self)
+        self.metrics = Metrics()
+
+        # every tile change increments the version, the log keeps
+        # (version, x, y, tile) for the last MAP_CHANGE_LOG changes
+        self.version = 0
+        self.changes = deque(maxlen=MAP_CHANGE_LOG)
+        self._snapshot = (None, None)
+        # packed replies of the what_* queries, cleared every tick and
+        # whenever a command changes what they report
+        self._queries = {}
+        self._queries_tick = 0
+
+        self.spawnpoints = layout.spawnpoints()
+        self.freespawnpoints = sorted(self.spawnpoints, reverse=True)
+        height, width = self._map.shape
+        self.frame = Rect(0, 0, width * TILE_WIDTH, height * TILE_HEIGHT)
+
+        # number of the current tick, on_tick is called with it before anything moves
+        self.tick = 0
+        self.on_tick = Signal()
+        self.on_player_join = Signal()
+        self.on_player_leave = Signal()
+        self.on_update_player = Signal()
+
+    def serialize(self):
+        """ one line of tile characters per row """
+        version, snapshot = self._snapshot
+        if version != self.version:
+            chars = TILE_CHARS[self._map]
+            snapshot = b"\n".join(chars.view("S{}".format(chars.shape[1])).ravel()).decode()
+            self._snapshot = (self.version, snapshot)
+        return snapshot
+
+    def bomb_states(self, frame=None):
+        """ (position, timer, state) of the bombs, only those within frame if given """
+        if frame is None:
+            bombs = self.items
+        else:
+            bombs = sorted(self.index.query(frame), key=lambda obj: getattr(obj, "eid", 0))
+        return [(b.position_int, b.update_timer, b.state,) for b in bombs if isinstance(b, Bomb)]
+
+    def foe_states(self, frame=None):
+        """ (position, direction, id, name) of the players, only those within frame if given """
+        if frame is None:
+            players = self.players
+        else:
+            players = sorted((obj for obj in self.index.query(frame) if isinstance(obj, Player)),
+                key=lambda p: p.id)
+        return [(p.position_int, p.direction, p.id, p.name) for p in players]
+
+    def tile_changes(self, version):
+        """
+        the (x, y, tile) changes since the given version, None if the
+        version is unknown, not a number or too old for the change log
+        """
+        oldest = self.changes[0][0] if self.changes else self.version + 1
+        if not isinstance(version, int) or not oldest - 1 <= version <= self.version:
+            return None
+        return [(x, y, tile) for _, x, y, tile in islice(self.changes, version - oldest + 1, None)]
+
+    def packed_query(self, msg_type, build):
+        """
+        the reply (msg_type, build(), tick) packed with msgpack
+
+        it is built at most once per tick and shared by every client asking
+        until invalidate_queries drops it.
+        """
+        if self._queries_tick != self.tick:
+            self._queries.clear()
+            self._queries_tick = self.tick
+        data = self._queries.get(msg_type)
+        if data is None:
+            args = build()
+            data = self._queries[msg_type] = PackedReply(msgpack.packb((msg_type, args, self.tick)))
+            data.reply = (msg_type, args)
+        return data
+
+    def invalidate_queries(self, *msg_types):
+        """ drop the cached replies of the given types, all of them without any """
+        if not msg_types:
+            self._queries.clear()
+        for msg_type in msg_types:
+            self._queries.pop(msg_type, None)
+
+    def delta(self, version=None):
+        """
+        returns [version, changes, snapshot]
+
+        changes are the [x, y, char] tile changes since the given version.
+        if the version is unknown or too old for the change log, changes is
+        empty and snapshot contains the whole map, otherwise it is None.
+        """
+        changes = self.tile_changes(version)
+        if changes is None:
+            return [self.version, [], self.serialize()]
+        return [self.version, [[x, y, TILE_CHARS[tile].decode()] for x, y, tile in changes], None]
+
+    def set_tile(self, position, tile):
+        x, y = position
+        self._map[y, x] = tile
+        self.version += 1
+        self.changes.append((self.version, x, y, tile))
+
+    def wall_tiles(self):
+        for y, x in np.argwhere(IS_WALL[self._map]):
+            yield int(x), int(y), int(self._map[y, x])
+
+    def colliders(self, frame):
+        """ frames of all walls and bombs that collide with frame """
+        height, width = self._map.shape
+        x0 = max(frame.left // TILE_WIDTH, 0)
+        y0 = max(frame.top // TILE_HEIGHT, 0)
+        x1 = min((frame.right - 1) // TILE_WIDTH, width - 1)
+        y1 = min((frame.bottom - 1) // TILE_HEIGHT, height - 1)
+
+        frames = []
+        block = IS_WALL[self._map[y0:y1 + 1, x0:x1 + 1]].tolist()
+        for y, line in enumerate(block, y0):
+            for x, is_wall in enumerate(line, x0):
+                if is_wall:
+                    frames.append(Rect(x * TILE_WIDTH, y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT))
+        frames.extend(obj.frame for obj in self.index.query(frame)
+            if isinstance(obj, COLLIDING_OBJECTS))
+        return frames
+
+    def blocked(self, position):
+        """ if a player cannot enter the tile: the map border, walls and bombs """
+        x, y = position
+        height, width = self._map.shape
+        if not (0 <= x < width and 0 <= y < height) or IS_WALL[self._map[y, x]]:
+            return True
+        return any(isinstance(obj, COLLIDING_OBJECTS) for obj in self.index.at(position))
+
+    def cast_ray(self, position, direction, radius):
+        """
+        follow a ray of fire from position until it hits a wall, the map
+        border or reaches radius. returns the last tile it reaches and if
+        this is a destructable wall.
+        """
+        x, y = position
+        left, top = directions[direction]
+        if left:
+            line, start = self._map[y, :], x
+        else:
+            line, start = self._map[:, x], y
+        if left + top > 0:
+            ray = line[start:start + radius + 1]
+        else:
+            ray = line[max(start - radius, 0):start + 1][::-1]
+
+        hits = np.flatnonzero(IS_WALL[ray])
+        length = hits[0] if len(hits) else len(ray) - 1
+        end = (x + left * int(length), y + top * int(length))
+        return end, bool(ray[length] == DESTRUCTABLE_WALL)
+
+    def destroy_walls(self, positions):
+        """ returns the number of walls that were still standing """
+        destroyed = 0
+        for x, y in sorted(set(positions)):
+            if self._map[y, x] == DESTRUCTABLE_WALL:
+                self.set_tile((x, y), DESTROYED_WALL)
+                destroyed += 1
+        return destroyed
+
+    def player_register(self, client, username=None, password="", **kw):
+        if not isinstance(username, str):
+            client.inform("ERR", "connect needs the username to be a string")
+            return False
+        if username in self.users:
+            position = self.users[username]
+        elif self.freespawnpoints:
+            position = self.freespawnpoints.pop()
+            self.users[username] = position
+        else:
+            client.inform("ERR", "match full")
             return False
 
         old_player = self.player_unregister(position, password)
+        points = old_player.points if old_player else 0
+        if old_player is None and username in self.departed:
+            departed_password, departed_points = self.departed[username]
+            if departed_password == password:
+                del self.departed[username]
+                points = departed_points
         player = Player(
             position=self.spawnpoints[position],
             client=client,
@@ -534,9 +837,10 @@ class Map(ui.View):
             name=username,
             password=password,
         )
-        if old_player:
-            player.points = old_player.points
+        player.points = points
         self.players.append(player)
+        self.index.insert(player)
+        self.invalidate_queries("WHAT_FOES")
         self.on_update_player(player)
         return position
 
@@ -548,51 +852,62 @@ class Map(ui.View):
                 break
         if old_player:
             assert old_player.password == password
+            self.index.remove(old_player)
         np = [p for p in self.players if p.id != position]
         if len(self.players) > len(np):
             self.players = np
-            # self.freespawnpoints.append(position)
+            self.invalidate_queries("WHAT_FOES")
         return old_player
 
+    def player_leave(self, client):
+        """ remove the player of a client that went away, returns it or None """
+        for player in self.players:
+            if player.client is client:
+                self.player_unregister(player.id, player.password)
+                # the spawn point is free for the next player
+                del self.users[player.name]
+                self.freespawnpoints.append(player.id)
+                self.freespawnpoints.sort(reverse=True)
+                self.departed.pop(player.name, None)
+                self.departed[player.name] = (player.password, player.points)
+                if len(self.departed) > MAX_DEPARTED:
+                    self.departed.popitem(last=False)
+                self.on_player_leave(player)
+                return player
+        return None
+
     def plant_bomb(self, player, fuse_time):
-        bombs = [b for b in self.items if isinstance(b, Bomb) and b.player is player and b.state == "ticking"]
-        if len(bombs) >= player.bombamount:
+        if player.live_bombs >= player.bombamount:
             return False
-        self.items.append(Bomb(
+        bomb = Bomb(
             player=player,
             fuse_time=fuse_time,
             position=player.position_int,
-        ))
-
-    def draw(self):
-        if not super().draw():
-            return False
-        ui.render.fillrect(self.surface,
-            [(173, 222, 78), (153, 202, 58)],
-            ui.Rect(0, 0, self.frame.w, self.frame.h)
         )
-
-        # draw walls
-        for wall in self.walls:
-            ui.render.fillrect(self.surface, wall.color, wall.frame)
-
-        # draw items
-        for item in self.items:
-            ui.render.fillrect(self.surface, item.color, item.frame)
-
-        # draw player
-        for player in self.players:
-            if player.hidden:
-                continue
-            ui.render.fillrect(self.surface, player.color, player.frame)
-        return True
+        player.live_bombs += 1
+        self.items.add(bomb)
+        self.index.insert(bomb)
+        self.explosions.planted(bomb)
+        self.invalidate_queries("WHAT_BOMBS", "DANGER")
 
     def update(self, dt):
-        for player in self.players:
-            player.update(dt)
-
-        for item in self.items:
-            item.update(dt)
-
-        self.items = [i for i in self.items if not i.hidden]
-        self.walls = [w for w in self.walls if not w.hidden]
+        metrics = self.metrics
+        self.tick += 1
+        with metrics.time("tick"):
+            self.on_tick(self.tick)
+
+            # resurrections and the state changes of the bombs
+            with metrics.time("tick.timers"):
+                self.clock.advance(dt)
+
+            with metrics.time("tick.players"):
+                for player in self.players:
+                    player.update(dt)
+
+            with metrics.time("tick.explosions"):
+                self.explosions.update()
+
+            with metrics.time("tick.subscriptions"):
+                for player in self.players:
+                    if player.aoi is not None and player.alive:
+                        player.send_aoi()
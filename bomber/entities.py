@@ -0,0 +1,43 @@
+from itertools import count
+
+
+class EntityStore:
+
+    """
+    the bombs and fire trails of a map
+
+    every entity gets a stable id and can be removed in O(1), iteration
+    goes over a snapshot that is only rebuilt after the store changed, so
+    entities may be added and removed while iterating.
+    """
+
+    def __init__(self):
+        self._entities = {}
+        self._ids = count(1)
+        self._snapshot = ()
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self):
+        if self._snapshot is None:
+            self._snapshot = tuple(self._entities.values())
+        return iter(self._snapshot)
+
+    def __contains__(self, entity):
+        return self._entities.get(entity.eid) is entity
+
+    def get(self, eid):
+        return self._entities.get(eid)
+
+    def add(self, entity):
+        entity.eid = next(self._ids)
+        entity.store = self
+        self._entities[entity.eid] = entity
+        self._snapshot = None
+        return entity.eid
+
+    def remove(self, entity):
+        if self._entities.pop(entity.eid, None) is not None:
+            self._snapshot = None
+        entity.store = None
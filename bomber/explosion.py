@@ -0,0 +1,121 @@
+from collections import Counter, deque
+
+from bomber.callback import Signal
+
+
+class Blast:
+
+    """ the tiles a bomb sets on fire, computed once per bomb """
+
+    __slots__ = ("rays", "cells")
+
+    def __init__(self, rays, cells):
+        # [(end, destroys_wall)] for every direction
+        self.rays = rays
+        self.cells = cells
+
+
+class ExplosionEngine:
+
+    """
+    resolves explosions for a Map
+
+    when a bomb detonates its blast cells and the chain reaction it causes
+    are computed once, every bomb in the chain is ignited exactly once.
+    while bombs burn their cells are kept in an occupancy counter, so
+    damage is a lookup per player instead of a check of every fire trail
+    against every player and bomb.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        # cell -> number of bombs burning it
+        self.burning = Counter()
+        # ignited bombs -> the timer that sets them off
+        self.fuses = {}
+        # called with a bomb whenever it is planted, goes off or burns out
+        self.on_change = Signal()
+
+    def cast(self, position, radius):
+        """ the blast of a bomb at position if it went off now """
+        x, y = position
+        rays = []
+        cells = {(x, y)}
+        for direction in "wasd":
+            end, destroys_wall = self.map.cast_ray((x, y), direction, radius)
+            rays.append((end, destroys_wall))
+            _x, _y = end
+            for cx in range(min(x, _x), max(x, _x) + 1):
+                for cy in range(min(y, _y), max(y, _y) + 1):
+                    cells.add((cx, cy))
+        return Blast(rays, cells)
+
+    def blast(self, bomb):
+        if bomb.blast is None:
+            bomb.blast = self.cast(bomb.position_int, bomb.explosion_radius)
+        return bomb.blast
+
+    def ticking_bombs(self, cell):
+        return [obj for obj in self.map.index.at(cell)
+            if getattr(obj, "state", None) == "ticking" and not obj.ignited]
+
+    def chain(self, bomb):
+        """
+        breadth first walk over the bombs this bomb ignites
+
+        returns [(bomb, delay)], delay is the time after the detonation of
+        the first bomb at which each following bomb goes off.
+        """
+        seen = {bomb}
+        order = [(bomb, 0.)]
+        queue = deque(order)
+        while queue:
+            current, delay = queue.popleft()
+            for cell in sorted(self.blast(current).cells):
+                for other in self.ticking_bombs(cell):
+                    if other in seen:
+                        continue
+                    seen.add(other)
+                    entry = (other, delay + current.ignite_time)
+                    order.append(entry)
+                    queue.append(entry)
+        return order
+
+    def detonate(self, bomb):
+        bomb.ignited = True
+        bomb.detonated = self.map.clock.time
+        self.fuses.pop(bomb, None)
+        blast = self.blast(bomb)
+        self.burning.update(blast.cells)
+        for other, delay in self.chain(bomb)[1:]:
+            other.ignited = True
+            self.fuses[other] = self.map.clock.call_later(delay, other.ignite)
+        self.on_change(bomb)
+        return blast
+
+    def extinguish(self, bomb):
+        self.fuses.pop(bomb, None)
+        self.on_change(bomb)
+        if bomb.blast is None:
+            return
+        self.burning.subtract(bomb.blast.cells)
+        for cell in bomb.blast.cells:
+            if self.burning[cell] <= 0:
+                del self.burning[cell]
+
+    def planted(self, bomb):
+        """ bombs planted into fire go off right away """
+        if bomb.position_int in self.burning:
+            bomb.ignited = True
+            self.fuses[bomb] = self.map.clock.call_later(bomb.ignite_time, bomb.ignite)
+        self.on_change(bomb)
+
+    def update(self):
+        if not self.burning:
+            return
+        index = self.map.index
+        for player in self.map.players:
+            if not player.alive:
+                continue
+            if any(cell in self.burning for cell in index.cells(player.frame)):
+                player.die()
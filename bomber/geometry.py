@@ -0,0 +1,70 @@
+class Rect:
+
+    """
+    lightweight stand-in for pygame.Rect
+
+    the simulation only needs integer positions and collision checks, so
+    it does not have to import pygame/SDL at all. like pygame.Rect all
+    coordinates are truncated to integers.
+    """
+
+    __slots__ = ("left", "top", "width", "height")
+
+    def __init__(self, left, top, width, height):
+        self.left = int(left)
+        self.top = int(top)
+        self.width = int(width)
+        self.height = int(height)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, int(value))
+
+    def __iter__(self):
+        return iter((self.left, self.top, self.width, self.height))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return "<Rect({}, {}, {}, {})>".format(*self)
+
+    @property
+    def right(self):
+        return self.left + self.width
+
+    @right.setter
+    def right(self, value):
+        self.left = int(value) - self.width
+
+    @property
+    def bottom(self):
+        return self.top + self.height
+
+    @bottom.setter
+    def bottom(self, value):
+        self.top = int(value) - self.height
+
+    @property
+    def w(self):
+        return self.width
+
+    @property
+    def h(self):
+        return self.height
+
+    def copy(self):
+        return Rect(self.left, self.top, self.width, self.height)
+
+    def colliderect(self, other):
+        return (self.left < other.left + other.width and other.left < self.left + self.width and
+                self.top < other.top + other.height and other.top < self.top + self.height)
+
+    def clip(self, other):
+        """ the part of this rect inside other, a zero sized rect if they do not overlap """
+        left = max(self.left, other.left)
+        top = max(self.top, other.top)
+        right = min(self.right, other.right)
+        bottom = min(self.bottom, other.bottom)
+        if right <= left or bottom <= top:
+            return Rect(self.left, self.top, 0, 0)
+        return Rect(left, top, right - left, bottom - top)
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from itertools import count
+
+from bomber.clock import TickScheduler
+from bomber.engine import Map
+from bomber.maps import load_layout
+from bomber.network import Server
+
+
+async def relay(reader, writer):
+    """ copy bytes from reader to writer until one side goes away """
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class MatchWorker:
+
+    """
+    runs many matches inside one worker process
+
+    the lobby opens one unix socket connection per client and starts it
+    with a json line naming the match and the real peer, everything after
+    that line is the normal client protocol.
+    """
+
+    def __init__(self, mapfile="simple.map"):
+        self.mapfile = mapfile
+        self.matches = {}
+
+    async def client_connected(self, reader, writer):
+        header = json.loads((await reader.readline()).decode())
+        match_id = header["match"]
+        if match_id not in self.matches:
+            self.matches[match_id] = Server(level=Map(mapfile=self.mapfile))
+        server = self.matches[match_id]
+        await server.client_connected(reader, writer, peername=tuple(header["peer"]))
+
+    def update(self, dt):
+        for match_id, server in list(self.matches.items()):
+            server.level.update(dt)
+            server.flush()
+            if not server.clients:
+                # everybody left
+                del self.matches[match_id]
+
+
+def run_worker(path, tick_rate=30, max_catchup=5, mapfile="simple.map"):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    worker = MatchWorker(mapfile=mapfile)
+    scheduler = TickScheduler(rate=tick_rate, max_catchup=max_catchup, loop=loop)
+    scheduler.on_tick.connect(worker.update)
+
+    loop.run_until_complete(asyncio.start_unix_server(worker.client_connected, path))
+    try:
+        loop.run_until_complete(scheduler.run())
+    finally:
+        loop.close()
+
+
+class Lobby:
+
+    """
+    front door for many matches
+
+    clients connect to a single port and are assigned to the first match
+    with a free slot. the matches are spread over a pool of worker
+    processes, the lobby only relays the raw bytes between the client and
+    the worker that owns its match.
+    """
+
+    def __init__(self, host='*', port=8001, workers=None, players_per_match=8,
+                 tick_rate=30, max_catchup=5, mapfile="simple.map"):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        # a match never holds more players than the map has spawn points
+        self.players_per_match = min(players_per_match, len(load_layout(mapfile).spawnpoints()))
+        self.tick_rate = tick_rate
+        self.max_catchup = max_catchup
+        self.mapfile = mapfile
+        self.processes = []
+        self.paths = []
+        # match id -> number of connected clients
+        self.matches = {}
+        self._match_ids = count()
+        self._socket_dir = tempfile.mkdtemp(prefix="bomber-")
+        self.server = None
+
+    def start_workers(self):
+        for i in range(self.workers):
+            path = os.path.join(self._socket_dir, "worker-{}.sock".format(i))
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(path, self.tick_rate, self.max_catchup, self.mapfile),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+            self.paths.append(path)
+
+    def stop_workers(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    def assign(self):
+        for match_id, players in sorted(self.matches.items()):
+            if players < self.players_per_match:
+                break
+        else:
+            match_id = next(self._match_ids)
+        self.matches[match_id] = self.matches.get(match_id, 0) + 1
+        return match_id
+
+    def release(self, match_id):
+        self.matches[match_id] -= 1
+        if not self.matches[match_id]:
+            del self.matches[match_id]
+
+    async def run_server(self):
+        self.start_workers()
+        while not all(os.path.exists(path) for path in self.paths):
+            await asyncio.sleep(0.05)
+        try:
+            self.server = await asyncio.start_server(
+                self.client_connected,
+                self.host, self.port
+            )
+            print('Running lobby on {}:{} with {} workers'.format(self.host, self.port, self.workers))
+        except OSError:
+            print('Cannot bind to this port! Is the server already running?')
+
+    async def client_connected(self, reader, writer):
+        peername = writer.transport.get_extra_info('peername')
+        match_id = self.assign()
+        path = self.paths[match_id % len(self.paths)]
+        try:
+            worker_reader, worker_writer = await asyncio.open_unix_connection(path)
+            header = {"match": match_id, "peer": list(peername)}
+            worker_writer.write(json.dumps(header).encode() + b"\n")
+            await asyncio.gather(
+                relay(reader, worker_writer),
+                relay(worker_reader, writer),
+            )
+        except OSError as e:
+            print('ERROR: {}'.format(e))
+            writer.close()
+        finally:
+            self.release(match_id)
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+# tile codes of the static map layer
+GROUND = 0
+DESTRUCTABLE_WALL = 1
+INDESTRUCTABLE_WALL = 2
+DESTROYED_WALL = 3
+# only in layouts: becomes a destructable wall or ground when a map is instantiated
+RANDOM_WALL = 255
+
+TILE_CHARS = np.array([b"g", b"W", b"M", b"w"])
+IS_WALL = np.array([False, True, True, False])
+
+# chance of a random tile to become a destructable wall
+WALL_DENSITY = 0.6
+
+MAGIC = b"BMAP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBHH")
+
+# spawn points of generated maps, (x, y) in units of the map size, like simple.map
+SPAWN_LAYOUT = {
+    "1": (0, 0), "7": (0.5, 0), "4": (1, 0),
+    "5": (0, 0.5), "6": (1, 0.5),
+    "3": (0, 1), "8": (0.5, 1), "2": (1, 1),
+}
+
+_layouts = {}
+
+
+def cache_dir():
+    default = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", default), "bomber", "maps")
+
+
+class Layout:
+
+    """
+    a compiled map file
+
+    tiles holds the tile codes with RANDOM_WALL for the free tiles, attrs
+    the spawn point markers (ascii code of the attribute, 0 for none).
+    """
+
+    __slots__ = ("tiles", "attrs")
+
+    def __init__(self, tiles, attrs):
+        self.tiles = tiles
+        self.attrs = attrs
+
+    @property
+    def shape(self):
+        return self.tiles.shape
+
+    def spawnpoints(self):
+        return {chr(self.attrs[y, x]): (int(x), int(y)) for y, x in np.argwhere(self.attrs)}
+
+    def instantiate(self, seed=None):
+        """ tile codes with the random walls placed, the same seed gives the same map """
+        tiles = self.tiles.copy()
+        free = tiles == RANDOM_WALL
+        walls = np.random.RandomState(seed).random_sample(tiles.shape) < WALL_DENSITY
+        tiles[free] = np.where(walls[free], DESTRUCTABLE_WALL, GROUND)
+        return tiles
+
+    def to_bytes(self):
+        height, width = self.tiles.shape
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, height, width)
+        return header + self.tiles.tobytes() + self.attrs.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, height, width = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a compiled map")
+        size = height * width
+        if len(data) != HEADER.size + 2 * size:
+            raise ValueError("truncated compiled map")
+        tiles = np.frombuffer(data, np.uint8, size, HEADER.size).reshape(height, width)
+        attrs = np.frombuffer(data, np.uint8, size, HEADER.size + size).reshape(height, width)
+        return cls(tiles.copy(), attrs.copy())
+
+    def to_text(self):
+        """ the .map file format, two characters per tile: attribute and block """
+        blocks = np.full(self.tiles.shape, ord(" "), dtype=np.uint8)
+        blocks[self.tiles == GROUND] = ord("g")
+        blocks[self.tiles == DESTRUCTABLE_WALL] = ord("W")
+        blocks[self.tiles == INDESTRUCTABLE_WALL] = ord("M")
+        blocks[self.attrs != 0] = ord("S")
+        attrs = np.where(self.attrs != 0, self.attrs, ord(" ")).astype(np.uint8)
+        raw = np.empty((blocks.shape[0], blocks.shape[1] * 2), dtype=np.uint8)
+        raw[:, 0::2], raw[:, 1::2] = attrs, blocks
+        return "\n".join(line.tobytes().decode() for line in raw) + "\n"
+
+
+def parse_layout(data):
+    """ compile the text of a .map file """
+    lines = data.splitlines()
+    # every tile is two characters: attribute and block
+    width = max(len(line) for line in lines)
+    width += width % 2
+    raw = np.frombuffer(b"".join(line.ljust(width) for line in lines), dtype=np.uint8)
+    raw = raw.reshape(len(lines), width)
+    attrs, blocks = raw[:, 0::2], raw[:, 1::2]
+
+    tiles = np.full(blocks.shape, GROUND, dtype=np.uint8)
+    tiles[blocks == ord("W")] = DESTRUCTABLE_WALL
+    tiles[blocks == ord("M")] = INDESTRUCTABLE_WALL
+    tiles[blocks == ord(" ")] = RANDOM_WALL
+    # spawn points, attr is the start position
+    spawn = blocks == ord("S")
+    return Layout(tiles, np.where(spawn, attrs, 0).astype(np.uint8))
+
+
+def load_layout(path):
+    """
+    compiled layout of a map file
+
+    layouts are cached by the hash of the file in memory and as compiled
+    binary files in the cache directory.
+    """
+    with open(path, "rb") as fh:
+        data = fh.read()
+    key = hashlib.sha1(data).hexdigest()
+    if key in _layouts:
+        return _layouts[key]
+
+    cached = os.path.join(cache_dir(), key + ".bmap")
+    try:
+        with open(cached, "rb") as fh:
+            layout = Layout.from_bytes(fh.read())
+    except (OSError, ValueError, struct.error):
+        layout = parse_layout(data)
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            with open(cached, "wb") as fh:
+                fh.write(layout.to_bytes())
+        except OSError:
+            pass
+    _layouts[key] = layout
+    return layout
+
+
+def generate_layout(width, height, players=8):
+    """
+    procedural layout in the style of simple.map
+
+    a pillar on every odd tile, up to eight spawn points in the corners and
+    the middle of the edges, each with some ground and a ring of
+    destructable walls around it. width and height should be odd.
+    """
+    tiles = np.full((height, width), RANDOM_WALL, dtype=np.uint8)
+    tiles[1::2, 1::2] = INDESTRUCTABLE_WALL
+    attrs = np.zeros((height, width), dtype=np.uint8)
+
+    spawns = sorted(SPAWN_LAYOUT.items())[:players]
+    for attr, (fx, fy) in spawns:
+        # spawn points always lie on even tiles, between the pillars
+        x = int(round(fx * (width - 1) / 2)) * 2
+        y = int(round(fy * (height - 1) / 2)) * 2
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                _x, _y = x + dx, y + dy
+                if not (0 <= _x < width and 0 <= _y < height):
+                    continue
+                if tiles[_y, _x] == INDESTRUCTABLE_WALL:
+                    continue
+                distance = max(abs(dx), abs(dy))
+                tiles[_y, _x] = GROUND if distance < 2 else DESTRUCTABLE_WALL
+        attrs[y, x] = ord(attr)
+    return Layout(tiles, attrs)
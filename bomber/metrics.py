@@ -0,0 +1,164 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+# upper bounds of the histogram buckets in seconds, 1us to ~1s
+BUCKETS = [1e-6 * 2 ** i for i in range(21)]
+
+
+class Histogram:
+
+    """ log scale histogram of durations in seconds """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ add the durations observed by another histogram """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """ upper bound of the bucket the percentile falls into """
+        if not self.count:
+            return 0.
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        ms = 1000
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * ms if self.count else 0.,
+            "p50_ms": self.percentile(0.5) * ms,
+            "p90_ms": self.percentile(0.9) * ms,
+            "p99_ms": self.percentile(0.99) * ms,
+            "max_ms": self.max * ms,
+        }
+
+
+class PhaseTimer:
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metrics:
+
+    """
+    histograms for the phases of a tick and the message handlers,
+    counters and the traffic of every client
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.clients = {}
+        self._timers = {}
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def time(self, name):
+        """ context manager that adds the duration of the block to a histogram """
+        if name not in self._timers:
+            self._timers[name] = PhaseTimer(self.histogram(name))
+        return self._timers[name]
+
+    def merge(self, histograms):
+        """ add histograms recorded elsewhere, by name, e.g. in the window process """
+        for name, other in histograms.items():
+            self.histogram(name).merge(other)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def client(self, peername):
+        key = str(peername)
+        if key not in self.clients:
+            self.clients[key] = {"bytes_in": 0, "bytes_out": 0, "messages": 0}
+        return self.clients[key]
+
+    def forget_client(self, peername):
+        self.clients.pop(str(peername), None)
+
+    def snapshot(self):
+        return {
+            "histograms": {name: h.to_dict() for name, h in sorted(self.histograms.items())},
+            "counters": dict(self.counters),
+            "gauges": {name: callback() for name, callback in self.gauges.items()},
+            "clients": dict(self.clients),
+        }
+
+
+class StatsServer:
+
+    """
+    read-only stats port
+
+    every connection gets the current snapshot as json (with a minimal
+    http header, so curl and browsers work) and is closed.
+    """
+
+    def __init__(self, metrics, host="127.0.0.1", port=8002):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def run_server(self):
+        try:
+            self.server = await asyncio.start_server(
+                self.client_connected,
+                self.host, self.port
+            )
+            print('Running stats on {}:{}'.format(self.host, self.port))
+        except OSError:
+            print('Cannot bind the stats port {}!'.format(self.port))
+
+    async def client_connected(self, reader, writer):
+        body = json.dumps(self.metrics.snapshot(), indent=2).encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n")
+        writer.write("Content-Length: {}\r\n\r\n".format(len(body)).encode())
+        writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
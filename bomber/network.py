@@ -1,6 +1,38 @@
 import asyncio
+import socket
+import time
+from collections import deque
+from itertools import count
 import msgpack
-import pygameui as ui
+from bomber.callback import Signal
+from bomber.maps import TILE_CHARS
+
+# adaptive read sizes of the inbound stream
+MIN_READ = 4096
+MAX_READ = 65536
+# bytes of a single unfinished message the unpacker may buffer
+MAX_BUFFER_SIZE = 256 * 1024
+# commands waiting for the next tick, more are refused
+MAX_INBOX = 256
+# commands of a single client processed per tick
+COMMANDS_PER_TICK = 16
+# unsent bytes of a spectator above which it skips frames
+SPECTATOR_BACKLOG = 64 * 1024
+# seconds a spectator may skip every frame before it is dropped
+SPECTATOR_STALL = 10
+# unsent bytes above which a client is too slow, see Server
+MAX_BACKLOG = 256 * 1024
+# connections of a single match server
+MAX_CLIENTS = 64
+# seconds without any data from a client before it is dropped, spectators excepted
+IDLE_TIMEOUT = 60
+
+
+def command_cost(msg):
+    """ how many of the commands per tick a message uses up """
+    if isinstance(msg, dict) and msg.get("type") == "batch" and isinstance(msg.get("commands"), list):
+        return max(len(msg["commands"]), 1)
+    return 1
 
 
 class ClientStub:
@@ -9,26 +41,118 @@ class ClientStub:
         self.reader = reader
         self.writer = writer
         self.peername = None
-        self.on_message = ui.callback.Signal()
+        self.on_message = Signal()
         self.state = "pending"
         self.level = level
+        # packed messages waiting for the next flush at the tick boundary
+        self.outbox = []
+        self.traffic = {"bytes_in": 0, "bytes_out": 0, "messages": 0}
+        # connection order, part of the order commands are applied in
+        self.number = 0
+        self._sequence = count()
+        # [tick, sequence, msg, merged moves, refused commands] waiting for their tick
+        self.inbox = deque()
+        # map version a spectator has seen, None before its first frame
+        self.version = None
+        # time.monotonic() a spectator started skipping frames, None while it keeps up
+        self.skipping_since = None
+        # time.monotonic() of the last data from the client
+        self.last_active = time.monotonic()
+        # unsent bytes above which push drops the updates
+        self.max_backlog = MAX_BACKLOG
 
     def inform(self, msg_type, args):
-        self.writer.write(msgpack.packb((msg_type, args)))
+        # every reply carries the tick it was produced in
+        self.send_packed(msgpack.packb((msg_type, args, self.level.tick)))
+
+    def push(self, msg_type, args):
+        """
+        like inform, for updates the client did not ask for: they are
+        dropped while the client is too slow, the next one replaces them.
+        returns if the update was sent
+        """
+        if self.backlog() > self.max_backlog:
+            self.level.metrics.count("dropped_updates")
+            return False
+        self.inform(msg_type, args)
+        return True
+
+    def send_packed(self, data):
+        if self.state != "closed":
+            self.outbox.append(data)
+
+    def flush(self):
+        if self.outbox:
+            data = b"".join(self.outbox)
+            self.outbox = []
+            self.traffic["bytes_out"] += len(data)
+            self.writer.write(data)
+
+    def receive(self, msg):
+        """ queue a command, it is stamped with the tick it will be applied in """
+        self.traffic["messages"] += 1
+        inbox = self.inbox
+        if isinstance(msg, dict) and msg.get("type") == "move" and inbox:
+            last = inbox[-1]
+            if isinstance(last[2], dict) and last[2].get("type") == "move" and not last[4]:
+                # only the latest move matters, the one it replaces is just acknowledged
+                last[2] = msg
+                last[3] += 1
+                return
+        if len(inbox) >= MAX_INBOX:
+            # refused after the last queued command, so the replies stay in order
+            inbox[-1][4] += 1
+            return
+        inbox.append([self.level.tick + 1, next(self._sequence), msg, 0, 0])
+
+    def take(self, limit=COMMANDS_PER_TICK):
+        """ remove up to limit queued commands, a batch counts as the commands it holds """
+        inbox = self.inbox
+        taken = []
+        while inbox:
+            cost = command_cost(inbox[0][2])
+            if taken and cost > limit:
+                break
+            taken.append(inbox.popleft())
+            limit -= cost
+            if limit <= 0:
+                break
+        return taken
+
+    def apply(self, entry):
+        _, _, msg, merged, refused = entry
+        for _ in range(merged):
+            self.inform("ACK", None)
+        self.handle_msg(msg)
+        for _ in range(refused):
+            self.inform("ERR", "too many commands, slow down")
 
     def handle_msg(self, msg):
         if self.state == "pending" and msg["type"] == "connect":
             # print(repr(msg))
             self.position = self.level.player_register(self, **msg)
-            self.state = "connected"
+            if self.position is not False:
+                self.state = "connected"
+        elif self.state == "pending" and msg["type"] == "spectate":
+            # from now on the client gets a frame every tick, see Server.stream
+            self.state = "spectating"
+            self.inform("ACK", None)
+        elif self.state == "spectating":
+            self.inform("ERR", "spectators cannot send commands")
         else:
             self.on_message(msg)
 
+    def backlog(self):
+        """ bytes written but not sent to the client yet """
+        if self.writer is None:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
     def bye(self):
-        try:
-            self.level.player_unregister(self.level)
-        except:
-            pass
+        self.state = "closed"
+        self.outbox = []
+        self.inbox.clear()
+        self.level.player_leave(self)
 
 
 class Server:
@@ -41,16 +165,36 @@ class Server:
     clients = {}
     server = None
 
-    def __init__(self, host='*', port=8001, level=None):
+    def __init__(self, host='*', port=8001, level=None, recorder=None,
+                 max_clients=MAX_CLIENTS, idle_timeout=IDLE_TIMEOUT, max_backlog=MAX_BACKLOG,
+                 slow_clients="drop"):
+        assert slow_clients in ("drop", "disconnect")
         self.host = host
         self.port = port
         self.level = level
         self.clients = {}
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        # clients with more unsent bytes are too slow. with "drop" the updates
+        # they did not ask for are dropped and they are only disconnected at
+        # four times the backlog, with "disconnect" right away
+        self.max_backlog = max_backlog
+        self.slow_clients = slow_clients
+        # bomber.replay.Recorder that logs every applied command
+        self.recorder = recorder
+        self._client_numbers = count()
+        # map version of the last spectator frame
+        self._stream_version = None
+        if level is not None:
+            self._stream_version = level.version
+            # queued commands are applied at the start of every tick
+            level.on_tick.connect(self.process_input)
+            level.metrics.gauge("spectators", lambda: sum(
+                1 for client in self.clients.values() if client.state == "spectating"))
 
-    @asyncio.coroutine
-    def run_server(self):
+    async def run_server(self):
         try:
-            self.server = yield from asyncio.start_server(
+            self.server = await asyncio.start_server(
                 self.client_connected,
                 self.host, self.port
             )
@@ -60,48 +204,194 @@ class Server:
 
     def send_to_client(self, peername, msg):
         client = self.clients[peername]
-        client.writer.write(msgpack.packb(msg))
+        client.send_packed(msgpack.packb(msg))
         return
 
     def send_to_all_clients(self, msg):
-        for peername in self.clients.keys():
-            self.send_to_client(peername, msg)
+        # pack once, every client gets the same bytes object
+        data = msgpack.packb(msg)
+        for client in self.clients.values():
+            client.send_packed(data)
         return
 
+    def process_input(self, tick):
+        """
+        apply the commands that arrived since the last tick
+
+        the order only depends on the tick a command is stamped with, the
+        connection order of the clients and the order a client sent its
+        commands in, not on the network timing within a tick.
+        """
+        batch = []
+        for peername, client in self.clients.items():
+            for entry in client.take():
+                batch.append((entry[0], client.number, entry[1], peername, client, entry))
+        batch.sort(key=lambda e: e[:3])
+
+        with self.level.metrics.time("messages"):
+            for _, _, _, peername, client, entry in batch:
+                if client.state == "closed":
+                    continue
+                if self.recorder is not None:
+                    self.recorder.command(tick, client.number, entry)
+                try:
+                    client.apply(entry)
+                except Exception as e:
+                    self.drop_client(peername, 'ERROR: {}'.format(e))
+
+    def disconnect(self, peername, error=None, abort=False):
+        """ the connection went away between two ticks """
+        client = self.clients.get(peername)
+        if client is not None and self.recorder is not None:
+            self.recorder.disconnect(self.level.tick + 1, client.number)
+        self.drop_client(peername, error, abort)
+
+    def drop_client(self, peername, error=None, abort=False):
+        """ abort discards what was not sent yet instead of sending the error """
+        client = self.clients.pop(peername, None)
+        if client is None:
+            return
+        if error is not None:
+            print(error)
+        if client.writer is not None:
+            if abort:
+                client.writer.transport.abort()
+            else:
+                if error is not None:
+                    client.send_packed(msgpack.packb(error))
+                    client.flush()
+                client.writer.write_eof()
+                # the reading side of a half-open connection would wait forever
+                client.writer.close()
+        client.bye()
+        self.level.metrics.forget_client(peername)
+
+    def flush(self):
+        """ write everything that was queued during this tick, one write per client """
+        self.stream()
+        now = time.monotonic()
+        limit = self.max_backlog if self.slow_clients == "disconnect" else 4 * self.max_backlog
+        for peername, client in list(self.clients.items()):
+            if client.writer is None:
+                continue
+            if client.backlog() > limit:
+                self.level.metrics.count("slow_clients")
+                self.disconnect(peername, "ERROR: {} is too slow".format(peername), abort=True)
+            elif client.state == "spectating":
+                # spectators only listen, but one that skipped every frame for a while is stuck
+                if client.skipping_since is not None and now - client.skipping_since > SPECTATOR_STALL:
+                    self.level.metrics.count("slow_clients")
+                    self.disconnect(peername, "ERROR: {} is stuck".format(peername), abort=True)
+            elif now - client.last_active > self.idle_timeout:
+                self.level.metrics.count("idle_clients")
+                self.disconnect(peername, "ERROR: {} is idle".format(peername))
+        for client in self.clients.values():
+            client.flush()
+
+    def stream(self):
+        """
+        queue the frame of this tick for all spectators
+
+        a frame holds the tile changes since the last frame, the players
+        and the bombs, it is packed once and the same bytes are queued for
+        every spectator. spectators that cannot keep up skip frames, when
+        they are back they first get a MAP_DELTA for the tiles they missed.
+        """
+        level = self.level
+        base, self._stream_version = self._stream_version, level.version
+        spectators = [client for client in self.clients.values() if client.state == "spectating"]
+        if not spectators:
+            return
+
+        with level.metrics.time("stream"):
+            changes = level.tile_changes(base)
+            if changes is None:
+                # more changes than the log holds, everybody gets a MAP_DELTA
+                base, changes = None, []
+            players = [
+                (p.id, p.frame.left, p.frame.top, p.alive, p.points) for p in level.players
+            ]
+            bombs = [
+                (item.eid,) + item.position_int + (item.state,)
+                for item in level.items if hasattr(item, "state")
+            ]
+            frame = msgpack.packb(("FRAME", [
+                level.version,
+                [[x, y, TILE_CHARS[tile].decode()] for x, y, tile in changes],
+                players,
+                bombs,
+            ], level.tick))
+
+            now = time.monotonic()
+            for client in spectators:
+                if client.backlog() > SPECTATOR_BACKLOG:
+                    level.metrics.count("stream.skipped_frames")
+                    if client.skipping_since is None:
+                        client.skipping_since = now
+                    continue
+                client.skipping_since = None
+                if client.version is None or client.version != base:
+                    client.inform("MAP_DELTA", level.delta(client.version))
+                client.send_packed(frame)
+                client.version = level.version
+
     def close_clients(self):
         for peername, client in self.clients.items():
-            client.writer.write_eof()
+            client.flush()
+            if client.writer is not None:
+                client.writer.write_eof()
+
+    def add_client(self, peername, client):
+        """ register a client, its commands are applied from the next tick on """
+        client.peername = peername
+        client.max_backlog = self.max_backlog
+        client.traffic = self.level.metrics.client(peername)
+        client.number = next(self._client_numbers)
+        # position = self.level.player_register(client)
+        self.clients[peername] = client
+        return client
 
-    @asyncio.coroutine
-    def client_connected(self, reader, writer):
-        peername = writer.transport.get_extra_info('peername')
+    async def client_connected(self, reader, writer, peername=None):
+        # relayed connections (see bomber.lobby) pass the peername of the real client
+        peername = peername or writer.transport.get_extra_info('peername')
+        if len(self.clients) >= self.max_clients:
+            self.level.metrics.count("refused_clients")
+            writer.write(msgpack.packb("ERROR: the server is full"))
+            writer.close()
+            return
         print("hallo {}".format(peername))
-        new_client = ClientStub(reader, writer, self.level)
-        # position = self.level.player_register(new_client)
-        self.clients[peername] = new_client
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family != socket.AF_UNIX:
+            # let the kernel notice peers that vanished without closing
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        new_client = self.add_client(peername, ClientStub(reader, writer, self.level))
         # self.send_to_client(peername, 'Welcome {}'.format(peername))
-        unpacker = msgpack.Unpacker(encoding='utf-8')
-        while not reader.at_eof():
+        unpacker = msgpack.Unpacker(encoding='utf-8', max_buffer_size=MAX_BUFFER_SIZE)
+        read_size = MIN_READ
+        while not reader.at_eof() and new_client.state != "closed":
             try:
-                pack = yield from reader.read(1024)
+                pack = await reader.read(read_size)
+                new_client.traffic["bytes_in"] += len(pack)
+                new_client.last_active = time.monotonic()
+                # grow the reads for clients that pipeline a lot, shrink them again when idle
+                if len(pack) == read_size:
+                    read_size = min(read_size * 2, MAX_READ)
+                elif len(pack) < read_size // 4:
+                    read_size = max(read_size // 2, MIN_READ)
                 unpacker.feed(pack)
                 for msg in unpacker:
-                    new_client.handle_msg(msg)
+                    new_client.receive(msg)
             except ConnectionResetError as e:
                 print('ERROR: {}'.format(e))
-                new_client.bye()
-                del self.clients[peername]
+                self.disconnect(peername)
                 # self.level.player_unregister(position)
                 return
             except Exception as e:
-                error = 'ERROR: {}'.format(e)
-                print(error)
-                self.send_to_client(peername, error)
-                new_client.writer.write_eof()
-                new_client.bye()
-                del self.clients[peername]
+                # also msgpack.BufferFull for oversized messages
+                self.disconnect(peername, 'ERROR: {!r}'.format(e))
                 # self.level.player_unregister(position)
                 return
+        self.disconnect(peername)
 
     def close(self):
         self.send_to_all_clients("bye\n")
@@ -0,0 +1,168 @@
+""" replay.py
+
+re-simulates a match recorded with `bomber.py --record=<file>` as fast as
+the CPU allows, without networking or rendering. run it with
+`python3 -m bomber.replay` from the repository root.
+
+Usage:
+    replay.py <file> [--repeat=<n>] [--profile]
+
+Options:
+    --repeat=<n>    replay the match n times [default: 1]
+    --profile       run the replay under cProfile and print the hottest functions
+"""
+import hashlib
+import time
+
+import msgpack
+from docopt import docopt
+
+from bomber.engine import Map
+from bomber.maps import Layout
+from bomber.network import ClientStub
+
+FORMAT_VERSION = 1
+
+
+def state_digest(level):
+    """ hash of everything a replay has to reproduce """
+    digest = hashlib.sha1(level._map.tobytes())
+    for player in sorted(level.players, key=lambda p: p.id):
+        digest.update(repr((player.id, player.frame, player.points, player.alive)).encode())
+    for item in level.items:
+        digest.update(repr((type(item).__name__, item.frame)).encode())
+    return digest.hexdigest()
+
+
+class Recorder:
+
+    """
+    input log of a match
+
+    a msgpack stream: a header with the compiled layout, the seed and the
+    tick rate, then every command in the order it was applied together
+    with its tick and the connection number of its client.
+    """
+
+    def __init__(self, path, level, tick_rate):
+        self.level = level
+        self.fh = open(path, "wb")
+        self.write({
+            "version": FORMAT_VERSION,
+            "layout": level.layout.to_bytes(),
+            "seed": level.seed,
+            "tick_rate": tick_rate,
+        })
+
+    def write(self, record):
+        self.fh.write(msgpack.packb(record, use_bin_type=True))
+
+    def command(self, tick, number, entry):
+        _, _, msg, merged, refused = entry
+        self.write(("cmd", tick, number, msg, merged, refused))
+
+    def disconnect(self, tick, number):
+        self.write(("bye", tick, number))
+
+    def close(self):
+        self.write(("end", self.level.tick, state_digest(self.level)))
+        self.fh.close()
+
+
+class ReplayClient(ClientStub):
+
+    """ a ClientStub without a connection, replies are only counted """
+
+    def __init__(self, level, number):
+        super().__init__(None, None, level)
+        self.number = number
+        self.replies = 0
+
+    def send_packed(self, data):
+        self.replies += 1
+
+
+def read_log(path):
+    with open(path, "rb") as fh:
+        unpacker = msgpack.Unpacker(fh, raw=False)
+        header = next(unpacker)
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError("unknown replay format")
+        return header, list(unpacker)
+
+
+def replay(header, records):
+    """ re-simulate the match, returns the map after the last tick and the recorded end """
+    level = Map(layout=Layout.from_bytes(header["layout"]), seed=header["seed"])
+    dt = 1 / header["tick_rate"]
+    clients = {}
+
+    by_tick = {}
+    end = None
+    for record in records:
+        if record[0] == "end":
+            end = record
+        else:
+            by_tick.setdefault(record[1], []).append(record)
+    last_tick = end[1] if end else max(by_tick or [0])
+
+    def apply(tick):
+        for record in by_tick.pop(tick, ()):
+            number = record[2]
+            if number not in clients:
+                clients[number] = ReplayClient(level, number)
+            client = clients[number]
+            if record[0] == "bye":
+                client.bye()
+            elif client.state != "closed":
+                msg = record[3]
+                if isinstance(msg, dict):
+                    # the handlers consume the message, keep the log intact for the next run
+                    msg = dict(msg)
+                try:
+                    client.apply([tick, 0, msg, record[4], record[5]])
+                except Exception:
+                    # the server dropped this client at the same point
+                    client.bye()
+
+    level.on_tick.connect(apply)
+    while level.tick < last_tick:
+        level.update(dt)
+    return level, end
+
+
+def main(arguments):
+    header, records = read_log(arguments["<file>"])
+    commands = sum(1 for record in records if record[0] == "cmd")
+
+    profile = None
+    if arguments["--profile"]:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    for _ in range(int(arguments["--repeat"])):
+        start = time.perf_counter()
+        level, end = replay(header, records)
+        duration = time.perf_counter() - start
+        print("{} ticks, {} commands in {:.3f}s: {:.0f} ticks/s, {:.1f}x realtime".format(
+            level.tick, commands, duration, level.tick / duration,
+            level.tick / header["tick_rate"] / duration))
+        if end is not None:
+            matches = state_digest(level) == end[2]
+            print("final state {} the recording".format("matches" if matches else "DIFFERS from"))
+
+    if profile is not None:
+        import pstats
+        profile.disable()
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+
+    histograms = level.metrics.snapshot()["histograms"]
+    for name, histogram in histograms.items():
+        if name.startswith("tick"):
+            print("{:<20} p50 {p50_ms:8.3f} ms   p99 {p99_ms:8.3f} ms   max {max_ms:8.3f} ms".format(
+                name, **histogram))
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -1,5 +1,104 @@
+import pygame
 import pygameui as ui
 
+from bomber.engine import TILE_COLORS, TILE_WIDTH, TILE_HEIGHT
+
+
+def to_ui_rect(frame):
+    return ui.Rect(frame.left, frame.top, frame.width, frame.height)
+
+
+class MapView(ui.View):
+
+    """
+    draws a match from a bomber.snapshot.SnapshotMap, the simulation itself
+    runs without it. the keys are sent as commands through the SnapshotMap.
+
+    the ground and the walls are rendered once into a cached background,
+    destroyed walls are patched in from the change log of the map. every
+    frame only the regions of the items and players of the previous and the
+    current frame are restored from the background and redrawn.
+    """
+
+    def __init__(self, map, offset=(10, 10)):
+        left, top = offset
+        super().__init__(ui.Rect(left, top, map.frame.width, map.frame.height))
+        self.map = map
+        self.ground = None
+        self.background = None
+        self.background_version = None
+        # the surface drawn on and the regions drawn over the background
+        # in the last frame, pygameui replaces the surface on layout
+        self.target = None
+        self.drawn = []
+
+    def key_down(self, key, code):
+        key_code = code.lower()
+        if key_code in ["w", "a", "s", "d"]:
+            self.map.send({"type": "move", "direction": key_code, "distance": 2.5})
+        elif key_code == "b":
+            self.map.send({"type": "bomb"})
+
+    def draw(self):
+        with self.map.metrics.time("draw"):
+            return self._draw()
+
+    def tile_rect(self, x, y):
+        return ui.Rect(x * TILE_WIDTH, y * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
+
+    def render_background(self):
+        """ ground and walls, returns the regions that changed since the last call """
+        if self.background is not None and self.background_version == self.map.version:
+            return []
+
+        if self.ground is None:
+            self.ground = pygame.Surface(self.surface.get_size())
+            ui.render.fillrect(self.ground,
+                [(173, 222, 78), (153, 202, 58)],
+                ui.Rect(0, 0, self.frame.w, self.frame.h)
+            )
+
+        changes = self.map.tile_changes(self.background_version)
+        if self.background is None or changes is None:
+            self.background = self.ground.copy()
+            for x, y, tile in self.map.wall_tiles():
+                ui.render.fillrect(self.background, TILE_COLORS[tile], self.tile_rect(x, y))
+            dirty = [ui.Rect(0, 0, self.frame.w, self.frame.h)]
+        else:
+            dirty = []
+            for x, y, tile in changes:
+                rect = self.tile_rect(x, y)
+                self.background.blit(self.ground, rect, rect)
+                if tile in TILE_COLORS:
+                    ui.render.fillrect(self.background, TILE_COLORS[tile], rect)
+                dirty.append(rect)
+        self.background_version = self.map.version
+        return dirty
+
+    def _draw(self):
+        if self.hidden:
+            return False
+
+        sprites = [(item.color, to_ui_rect(item.frame)) for item in self.map.items]
+        sprites.extend(
+            (player.color, to_ui_rect(player.frame))
+            for player in self.map.players if not player.hidden
+        )
+
+        dirty = self.render_background() + self.drawn
+        if self.surface is not self.target:
+            self.target = self.surface
+            dirty = [ui.Rect(0, 0, self.frame.w, self.frame.h)]
+
+        # restore what was drawn over in the last frame, then draw the
+        # items below the players
+        for rect in dirty:
+            self.surface.blit(self.background, rect, rect)
+        for color, rect in sprites:
+            ui.render.fillrect(self.surface, color, rect)
+        self.drawn = [rect for _, rect in sprites]
+        return True
+
 
 class LoadingScene(ui.Scene):
 
@@ -16,7 +115,8 @@ class MapScene(ui.Scene):
         super().__init__()
         self.map = map
         self.map.on_update_player.connect(self.update_player)
-        self.add_child(self.map)
+        self.map_view = MapView(map)
+        self.add_child(self.map_view)
         self.user = {}
         self.label = {}
         id_to_frame = {
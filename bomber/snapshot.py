@@ -0,0 +1,299 @@
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from bomber.callback import Signal
+from bomber.geometry import Rect
+from bomber.maps import IS_WALL
+from bomber.metrics import Metrics
+
+MAGIC = b"BSNP"
+# magic, map height, map width, number of slots, bytes per slot
+HEADER = struct.Struct("<4sHHII")
+# sequence number (0 while the slot is written), tick, map version, players, items
+SLOT_HEADER = struct.Struct("<QQQII")
+
+MAX_PLAYERS = 8
+MAX_ITEMS = 1024
+# seconds between two reports of the window's histograms to the simulation
+METRICS_INTERVAL = 1.
+
+PLAYER = np.dtype([
+    ("id", "S1"), ("name", "S16"), ("points", "<i4"), ("alive", "u1"), ("color", "u1", 3),
+    ("left", "<i4"), ("top", "<i4"), ("width", "<i4"), ("height", "<i4"),
+])
+ITEM = np.dtype([
+    ("color", "u1", 3), ("left", "<i4"), ("top", "<i4"), ("width", "<i4"), ("height", "<i4"),
+])
+
+
+def ring_dir():
+    # shared memory where there is one, a plain temp file otherwise
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class Snapshot:
+
+    """
+    views into one slot of a SnapshotRing, nothing is copied
+
+    the writer only reuses a slot after all others, valid() tells if that
+    happened while the snapshot was used.
+    """
+
+    def __init__(self, ring, slot, sequence, tick, version, tiles, players, items):
+        self.ring = ring
+        self.slot = slot
+        self.sequence = sequence
+        self.tick = tick
+        self.version = version
+        self.tiles = tiles
+        self.players = players
+        self.items = items
+
+    def valid(self):
+        return self.ring.sequence_of(self.slot) == self.sequence
+
+
+class SnapshotRing:
+
+    """
+    the state of a match after every tick in a file backed shared memory
+    ring, written by the simulation and read by other processes
+
+    a slot holds the tile codes, the players and the frames of the items.
+    every slot starts with its sequence number, it is zero while the slot
+    is written, the latest slot is the one with the highest number.
+    """
+
+    def __init__(self, path, fh, buffer, shape, slots, slot_size):
+        self.path = path
+        self.fh = fh
+        self.buffer = buffer
+        self.shape = shape
+        self.slots = slots
+        self.slot_size = slot_size
+        self.sequence = 0
+
+    @staticmethod
+    def slot_size_for(shape):
+        height, width = shape
+        return (SLOT_HEADER.size + height * width
+            + MAX_PLAYERS * PLAYER.itemsize + MAX_ITEMS * ITEM.itemsize)
+
+    @classmethod
+    def create(cls, shape, slots=8, path=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="bomber-", suffix=".ring", dir=ring_dir())
+            os.close(fd)
+        slot_size = cls.slot_size_for(shape)
+        fh = open(path, "w+b")
+        fh.truncate(HEADER.size + slots * slot_size)
+        buffer = mmap.mmap(fh.fileno(), 0)
+        HEADER.pack_into(buffer, 0, MAGIC, shape[0], shape[1], slots, slot_size)
+        return cls(path, fh, buffer, shape, slots, slot_size)
+
+    @classmethod
+    def open(cls, path):
+        fh = open(path, "r+b")
+        buffer = mmap.mmap(fh.fileno(), 0)
+        magic, height, width, slots, slot_size = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("not a snapshot ring")
+        return cls(path, fh, buffer, (height, width), slots, slot_size)
+
+    def close(self, unlink=False):
+        self.buffer.close()
+        self.fh.close()
+        if unlink:
+            os.unlink(self.path)
+
+    def offset(self, slot):
+        return HEADER.size + slot * self.slot_size
+
+    def sequence_of(self, slot):
+        return struct.unpack_from("<Q", self.buffer, self.offset(slot))[0]
+
+    def arrays(self, slot):
+        height, width = self.shape
+        offset = self.offset(slot) + SLOT_HEADER.size
+        tiles = np.frombuffer(self.buffer, np.uint8, height * width, offset).reshape(self.shape)
+        offset += height * width
+        players = np.frombuffer(self.buffer, PLAYER, MAX_PLAYERS, offset)
+        offset += MAX_PLAYERS * PLAYER.itemsize
+        items = np.frombuffer(self.buffer, ITEM, MAX_ITEMS, offset)
+        return tiles, players, items
+
+    def publish(self, level):
+        """ write the state of the level into the next slot """
+        self.sequence += 1
+        slot = self.sequence % self.slots
+        offset = self.offset(slot)
+        SLOT_HEADER.pack_into(self.buffer, offset, 0, 0, 0, 0, 0)
+        tiles, players, items = self.arrays(slot)
+
+        tiles[:] = level._map
+        count = 0
+        for player in level.players[:MAX_PLAYERS]:
+            frame = player.frame
+            # at most 16 bytes, cut on a character boundary
+            name = player.name.encode()[:16].decode(errors="ignore").encode()
+            players[count] = (player.id.encode(), name, player.points,
+                player.alive and not player.hidden, player.color,
+                frame.left, frame.top, frame.width, frame.height)
+            count += 1
+        shown = 0
+        for item in level.items:
+            if shown == MAX_ITEMS:
+                break
+            frame = item.frame
+            items[shown] = (item.color, frame.left, frame.top, frame.width, frame.height)
+            shown += 1
+
+        # the sequence number goes in last, it makes the slot visible
+        SLOT_HEADER.pack_into(self.buffer, offset, 0, level.tick, level.version, count, shown)
+        struct.pack_into("<Q", self.buffer, offset, self.sequence)
+
+    def latest(self):
+        """ the most recent complete Snapshot, None before the first one """
+        best, best_slot = 0, None
+        for slot in range(self.slots):
+            sequence = self.sequence_of(slot)
+            if sequence > best:
+                best, best_slot = sequence, slot
+        if best_slot is None:
+            return None
+        _, tick, version, count, shown = SLOT_HEADER.unpack_from(self.buffer, self.offset(best_slot))
+        tiles, players, items = self.arrays(best_slot)
+        return Snapshot(self, best_slot, best, tick, version, tiles, players[:count], items[:shown])
+
+
+class SnapshotPlayer:
+
+    __slots__ = ("id", "name", "points", "hidden", "color", "frame")
+
+    def __init__(self, record):
+        self.id = record["id"].decode()
+        self.name = record["name"].decode(errors="replace")
+        self.points = int(record["points"])
+        self.hidden = not record["alive"]
+        self.color = tuple(int(c) for c in record["color"])
+        self.frame = Rect(record["left"], record["top"], record["width"], record["height"])
+
+
+class SnapshotItem:
+
+    __slots__ = ("color", "frame")
+
+    def __init__(self, record):
+        self.color = tuple(int(c) for c in record["color"])
+        self.frame = Rect(record["left"], record["top"], record["width"], record["height"])
+
+
+class SnapshotMap:
+
+    """
+    the parts of a Map that bomber.scenes needs, read from a SnapshotRing
+
+    commands is an optional multiprocessing queue for the commands of the
+    keys pressed in the window, see receive_commands. the histograms the
+    view records in metrics go the same way, about once a second.
+    """
+
+    def __init__(self, ring, commands=None, tile_size=(10, 10)):
+        self.ring = ring
+        self.commands = commands
+        self.tile_width, self.tile_height = tile_size
+        height, width = ring.shape
+        self.frame = Rect(0, 0, width * self.tile_width, height * self.tile_height)
+        self.metrics = Metrics()
+        self.metrics_sent = time.perf_counter()
+        self.on_update_player = Signal()
+        self.tick = 0
+        self.version = None
+        self.tiles = np.zeros(ring.shape, dtype=np.uint8)
+        # the version before the last wall change and the (x, y, tile) changed since
+        self.previous_version = None
+        self.changes = []
+        self.players = []
+        self.items = []
+
+    def refresh(self):
+        """ take the latest snapshot, False if there is no new one """
+        if time.perf_counter() - self.metrics_sent >= METRICS_INTERVAL:
+            self.send_metrics()
+        snapshot = self.ring.latest()
+        if snapshot is None or snapshot.tick == self.tick:
+            return False
+        version = int(snapshot.version)
+        # the walls are only copied when they changed, they outlive the slot in the view's cache
+        tiles = snapshot.tiles.copy() if version != self.version else self.tiles
+        players = [SnapshotPlayer(record) for record in snapshot.players]
+        items = [SnapshotItem(record) for record in snapshot.items]
+        if not snapshot.valid():
+            # overwritten while we read it, try the next one
+            return False
+        before = {player.id: player.points for player in self.players}
+        if version != self.version:
+            self.previous_version = self.version
+            self.changes = [(int(x), int(y), int(tiles[y, x])) for y, x in np.argwhere(tiles != self.tiles)]
+        self.tick, self.version, self.tiles = snapshot.tick, version, tiles
+        self.players, self.items = players, items
+        for player in players:
+            if before.get(player.id) != player.points:
+                self.on_update_player(player)
+        return True
+
+    def send(self, msg):
+        """ send a command of the player at the window to the simulation """
+        if self.commands is not None:
+            self.commands.put(msg)
+
+    def send_metrics(self):
+        """ hand the histograms recorded since the last call to the simulation """
+        self.metrics_sent = time.perf_counter()
+        if self.commands is not None and self.metrics.histograms:
+            # the queue pickles them later, the view records into fresh ones
+            self.commands.put(("metrics", self.metrics.histograms))
+            self.metrics = Metrics()
+
+    def wall_tiles(self):
+        for y, x in np.argwhere(IS_WALL[self.tiles]):
+            yield int(x), int(y), int(self.tiles[y, x])
+
+    def tile_changes(self, version):
+        """
+        the (x, y, tile) changes since the given version, None unless it is
+        the current or the one before, snapshots do not carry the change log
+        """
+        if version is None:
+            return None
+        if version == self.version:
+            return []
+        if version == self.previous_version:
+            return self.changes
+        return None
+
+
+def receive_commands(client, commands, username="window"):
+    """
+    queue the commands the window process sent for client, on the side of
+    the simulation. the client joins the match with the first of them.
+    the histograms of the window are merged into the metrics of the level.
+    """
+    while True:
+        try:
+            msg = commands.get_nowait()
+        except queue.Empty:
+            return
+        if isinstance(msg, tuple) and msg[0] == "metrics":
+            client.level.metrics.merge(msg[1])
+            continue
+        if client.state == "pending" and not client.inbox:
+            client.receive({"type": "connect", "username": username})
+        client.receive(msg)
@@ -0,0 +1,74 @@
+from collections import defaultdict
+
+
+class SpatialIndex:
+
+    """
+    uniform grid of tile sized buckets
+
+    every object is stored in each bucket its frame overlaps, so a query
+    only has to look at the handful of buckets the query rect covers
+    instead of every object on the map.
+    """
+
+    def __init__(self, cell_width, cell_height):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        # dicts instead of sets keep the iteration order stable
+        self._buckets = defaultdict(dict)
+        self._cells = {}
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __contains__(self, obj):
+        return obj in self._cells
+
+    def cells(self, frame):
+        x0 = frame.left // self.cell_width
+        y0 = frame.top // self.cell_height
+        x1 = (frame.left + frame.width - 1) // self.cell_width
+        y1 = (frame.top + frame.height - 1) // self.cell_height
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def insert(self, obj):
+        if obj in self._cells:
+            self.remove(obj)
+        cells = self.cells(obj.frame)
+        for cell in cells:
+            self._buckets[cell][obj] = None
+        self._cells[obj] = cells
+        obj.index = self
+
+    def remove(self, obj):
+        cells = self._cells.pop(obj, None)
+        if cells is None:
+            return
+        for cell in cells:
+            bucket = self._buckets[cell]
+            bucket.pop(obj, None)
+            if not bucket:
+                del self._buckets[cell]
+        obj.index = None
+
+    def move(self, obj):
+        """ call this after the frame of an indexed object has changed """
+        cells = self.cells(obj.frame)
+        if cells != self._cells.get(obj):
+            self.insert(obj)
+
+    def at(self, cell):
+        return list(self._buckets.get(cell, ()))
+
+    def query(self, frame):
+        """ all objects whose frame collides with the given frame """
+        found = {}
+        buckets = self._buckets
+        for cell in self.cells(frame):
+            bucket = buckets.get(cell)
+            if not bucket:
+                continue
+            for obj in bucket:
+                if obj not in found and frame.colliderect(obj.frame):
+                    found[obj] = None
+        return list(found)